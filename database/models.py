@@ -1,18 +1,28 @@
 """
 Modelli e operazioni database MongoDB
 """
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 from datetime import datetime
-from typing import Optional, Dict, List
+from typing import Optional, Dict, Iterator, List
 from bson import ObjectId
 import logging
-from config.settings import MONGODB_URI, DATABASE_NAME, BOT_STATUS
+from config.settings import (MONGODB_URI, DATABASE_NAME, BOT_STATUS, MONGODB_MAX_POOL_SIZE,
+                             MONGODB_MIN_POOL_SIZE, MONGODB_COMPRESSORS)
 from utils.crypto_utils import crypto_utils
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Campi criptati delle API keys nel documento utente
+API_KEY_FIELDS = ("bitfinex_api_key", "bitfinex_api_secret", "bitmex_api_key", "bitmex_api_secret")
+
+# Campi del bot letti dall'opener (_id è sempre incluso)
+READY_BOT_FIELDS = ("user_id", "status", "transfer_reason", "exchange_long", "exchange_short", "capital",
+                    "capital_increase", "increase", "leverage", "rebalance_threshold", "safety_threshold",
+                    "stop_loss_percentage")
+
 class DatabaseManager:
     """Manager per operazioni database"""
     
@@ -25,7 +35,13 @@ class DatabaseManager:
         """Connessione al database"""
         try:
             # Sostituisci <db_password> con la password reale quando necessario
-            self.client = MongoClient(MONGODB_URI)
+            self.client = MongoClient(
+                MONGODB_URI,
+                maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                minPoolSize=MONGODB_MIN_POOL_SIZE,
+                retryWrites=True,
+                compressors=MONGODB_COMPRESSORS
+            )
             self.db = self.client[DATABASE_NAME]
             logger.info("Connesso a MongoDB")
         except Exception as e:
@@ -147,21 +163,41 @@ class UserManager:
     def get_user_api_keys(self, user_id: str) -> Dict[str, str]:
         """Recupera API keys utente decriptate"""
         try:
-            user = self.users.find_one({"_id": ObjectId(user_id)})
+            user = self.users.find_one({"_id": ObjectId(user_id)}, projection=API_KEY_FIELDS)
             if not user:
                 return {}
             
-            return {
-                "bitfinex_api_key": crypto_utils.decrypt_api_key(user.get("bitfinex_api_key", "")),
-                "bitfinex_api_secret": crypto_utils.decrypt_api_key(user.get("bitfinex_api_secret", "")),
-                "bitmex_api_key": crypto_utils.decrypt_api_key(user.get("bitmex_api_key", "")),
-                "bitmex_api_secret": crypto_utils.decrypt_api_key(user.get("bitmex_api_secret", ""))
-            }
+            return self._decrypt_api_keys(user)
             
         except Exception as e:
             logger.error(f"Errore recupero API keys: {e}")
             return {}
     
+    def get_users_api_keys(self, user_ids: List[str]) -> Dict[str, Dict[str, str]]:
+        """Recupera con una sola query le API keys decriptate di più utenti
+        
+        Args:
+            user_ids: ID degli utenti
+            
+        Returns:
+            Dict {user_id: api_keys} per gli utenti trovati
+        """
+        try:
+            object_ids = [ObjectId(user_id) for user_id in {str(u) for u in user_ids if u} if ObjectId.is_valid(user_id)]
+            if not object_ids:
+                return {}
+            
+            users = self.users.find({"_id": {"$in": object_ids}}, projection=API_KEY_FIELDS)
+            return {str(user["_id"]): self._decrypt_api_keys(user) for user in users}
+            
+        except Exception as e:
+            logger.error(f"Errore recupero API keys utenti: {e}")
+            return {}
+    
+    def _decrypt_api_keys(self, user: Dict) -> Dict[str, str]:
+        """Decripta le API keys di un documento utente"""
+        return {field: crypto_utils.decrypt_api_key(user.get(field, "")) for field in API_KEY_FIELDS}
+    
     def update_wallet(self, user_id: str, exchange: str, wallet_address: str) -> bool:
         """Aggiorna wallet address per exchange"""
         try:
@@ -279,6 +315,57 @@ class BotManager:
             logger.error(f"Errore recupero bot: {e}")
             return None
     
+    def _bot_status_update_data(self, status: str, stopped_type: str = None, started_type: str = None,
+                                transfer_reason: str = None, transfer_amount: float = None) -> Dict:
+        """Costruisce i campi da aggiornare per un cambio di status del bot"""
+        update_data = {"status": status}
+        
+        if status == BOT_STATUS["RUNNING"]:
+            # Bot avviato - imposta started_at e resetta transfer_reason
+            update_data["started_at"] = datetime.utcnow()
+            update_data["stopped_at"] = None
+            update_data["stopped_type"] = None
+            update_data["transfer_reason"] = None  # Sempre null quando diventa RUNNING
+            
+        elif status == BOT_STATUS["STOPPED"]:
+            # Bot fermato - imposta stopped_at e tipo
+            update_data["stopped_at"] = datetime.utcnow()
+            update_data["stopped_type"] = stopped_type or "manual"
+            
+        elif status == BOT_STATUS["STOP_REQUESTED"]:
+            # Richiesta di stop - non modificare timestamp, solo stato
+            # Non modifichiamo stopped_at perché non è ancora effettivamente fermato
+            update_data["stopped_type"] = stopped_type or "manual"
+            
+        elif status == BOT_STATUS["READY"]:
+            # Bot pronto - mantieni started_at se presente, resetta stopped
+            update_data["stopped_at"] = None
+            update_data["stopped_type"] = None
+            if started_type:
+                update_data["started_type"] = started_type
+                
+        elif status == BOT_STATUS["TRANSFERING"]:
+            # Bot in trasferimento - imposta started_type e mantiene transfer_reason
+            if started_type:
+                update_data["started_type"] = started_type
+            # Non resettiamo transfer_reason qui, viene mantenuto dal precedente stato
+                
+        elif status == BOT_STATUS["TRANSFER_REQUESTED"]:
+            # Bot richiede trasferimento - imposta stopped_type come motivo e transfer_reason
+            if stopped_type:
+                update_data["stopped_type"] = stopped_type
+            if transfer_reason:
+                update_data["transfer_reason"] = transfer_reason
+                
+        elif status == BOT_STATUS["EXTERNAL_TRANSFER_PENDING"]:
+            # Bot in attesa di trasferimento esterno - salva l'importo da trasferire
+            if transfer_amount is not None:
+                update_data["transfer_amount"] = transfer_amount
+            if transfer_reason:
+                update_data["transfer_reason"] = transfer_reason
+        
+        return update_data
+    
     def update_bot_status(self, user_id: str, status: str, stopped_type: str = None, started_type: str = None, transfer_reason: str = None, transfer_amount: float = None) -> bool:
         """Aggiorna status dell'istanza bot più recente dell'utente"""
         try:
@@ -289,51 +376,7 @@ class BotManager:
                 return False
             
             # Prepara update data
-            update_data = {"status": status}
-            
-            if status == BOT_STATUS["RUNNING"]:
-                # Bot avviato - imposta started_at e resetta transfer_reason
-                update_data["started_at"] = datetime.utcnow()
-                update_data["stopped_at"] = None
-                update_data["stopped_type"] = None
-                update_data["transfer_reason"] = None  # Sempre null quando diventa RUNNING
-                
-            elif status == BOT_STATUS["STOPPED"]:
-                # Bot fermato - imposta stopped_at e tipo
-                update_data["stopped_at"] = datetime.utcnow()
-                update_data["stopped_type"] = stopped_type or "manual"
-                
-            elif status == BOT_STATUS["STOP_REQUESTED"]:
-                # Richiesta di stop - non modificare timestamp, solo stato
-                # Non modifichiamo stopped_at perché non è ancora effettivamente fermato
-                update_data["stopped_type"] = stopped_type or "manual"
-                
-            elif status == BOT_STATUS["READY"]:
-                # Bot pronto - mantieni started_at se presente, resetta stopped
-                update_data["stopped_at"] = None
-                update_data["stopped_type"] = None
-                if started_type:
-                    update_data["started_type"] = started_type
-                    
-            elif status == BOT_STATUS["TRANSFERING"]:
-                # Bot in trasferimento - imposta started_type e mantiene transfer_reason
-                if started_type:
-                    update_data["started_type"] = started_type
-                # Non resettiamo transfer_reason qui, viene mantenuto dal precedente stato
-                    
-            elif status == BOT_STATUS["TRANSFER_REQUESTED"]:
-                # Bot richiede trasferimento - imposta stopped_type come motivo e transfer_reason
-                if stopped_type:
-                    update_data["stopped_type"] = stopped_type
-                if transfer_reason:
-                    update_data["transfer_reason"] = transfer_reason
-                    
-            elif status == BOT_STATUS["EXTERNAL_TRANSFER_PENDING"]:
-                # Bot in attesa di trasferimento esterno - salva l'importo da trasferire
-                if transfer_amount is not None:
-                    update_data["transfer_amount"] = transfer_amount
-                if transfer_reason:
-                    update_data["transfer_reason"] = transfer_reason
+            update_data = self._bot_status_update_data(status, stopped_type, started_type, transfer_reason, transfer_amount)
             
             # Aggiorna l'istanza specifica tramite _id
             result = self.bots.update_one(
@@ -352,6 +395,45 @@ class BotManager:
             logger.error(f"Errore aggiornamento status bot: {e}")
             return False
     
+    def bot_status_update(self, bot_id, status: str, stopped_type: str = None, transfer_reason: str = None) -> UpdateOne:
+        """
+        Prepara l'aggiornamento di status di un bot per bulk_update_bots
+        
+        Args:
+            bot_id: ID dell'istanza bot
+            status: Nuovo status
+            stopped_type: Tipo di stop (per STOPPED / STOP_REQUESTED / TRANSFER_REQUESTED)
+            transfer_reason: Motivo del trasferimento
+            
+        Returns:
+            UpdateOne: Operazione da eseguire
+        """
+        update_data = self._bot_status_update_data(status, stopped_type, transfer_reason=transfer_reason)
+        return UpdateOne({"_id": bot_id}, {"$set": update_data})
+    
+    def bulk_update_bots(self, operations: List[UpdateOne]) -> int:
+        """
+        Esegue più aggiornamenti di bot con un solo round trip
+        
+        Args:
+            operations: Lista di UpdateOne (es. da bot_status_update)
+            
+        Returns:
+            int: Numero di bot modificati
+        """
+        if not operations:
+            return 0
+        
+        try:
+            # ordered=False: gli aggiornamenti sono indipendenti, un errore non blocca gli altri
+            result = self.bots.bulk_write(operations, ordered=False)
+            logger.info(f"{result.modified_count}/{len(operations)} bot aggiornati")
+            return result.modified_count
+            
+        except Exception as e:
+            logger.error(f"Errore aggiornamento bot in blocco: {e}")
+            return 0
+    
     def update_capital_increase(self, user_id: str, capital_increase: float, increase: bool = True) -> bool:
         """Aggiorna i campi capital_increase e increase dell'istanza bot più recente dell'utente"""
         try:
@@ -386,11 +468,21 @@ class BotManager:
     
     def get_ready_bots(self) -> List[Dict]:
         """Recupera tutti i bot con status 'ready' o 'transfering'"""
+        return list(self.iter_ready_bots())
+    
+    def iter_ready_bots(self, batch_size: int = 64) -> Iterator[Dict]:
+        """Restituisce in streaming i bot con status 'ready' o 'transfering'
+        
+        Args:
+            batch_size: Documenti letti dal cursore per ogni round trip
+        """
         try:
-            return list(self.bots.find({"status": {"$in": [BOT_STATUS["READY"], BOT_STATUS["TRANSFERING"]]}}))
+            cursor = self.bots.find({"status": {"$in": [BOT_STATUS["READY"], BOT_STATUS["TRANSFERING"]]}},
+                                    projection=READY_BOT_FIELDS).batch_size(batch_size)
+            for bot in cursor:
+                yield bot
         except Exception as e:
             logger.error(f"Errore recupero bot ready/transfering: {e}")
-            return []
     
     def get_stop_requested_bots(self) -> List[Dict]:
         """Recupera tutti i bot con status 'stop_requested'"""
@@ -475,6 +567,11 @@ class PositionManager:
     def __init__(self, db_manager):
         self.db = db_manager
         self.positions = db_manager.db.positions
+        try:
+            # Indice per le query sulle posizioni aperte di uno o più bot
+            self.positions.create_index([("bot_id", 1), ("status", 1)])
+        except Exception as e:
+            logger.warning(f"Impossibile creare indice posizioni: {e}")
         logger.info("PositionManager inizializzato")
     
     def save_position(self, position_data):
@@ -514,6 +611,43 @@ class PositionManager:
             logger.error(f"Errore salvataggio posizione: {e}")
             return False
     
+    def save_positions(self, positions_data):
+        """
+        Salva più posizioni nel database con un unico insert_many
+        
+        Args:
+            positions_data (list): Lista dei dati delle posizioni
+            
+        Returns:
+            int: Numero di posizioni salvate
+        """
+        try:
+            required_fields = ['position_id', 'user_id', 'bot_id', 'exchange', 'symbol', 'side', 'size']
+            valid = []
+            for position_data in positions_data:
+                missing = [field for field in required_fields if field not in position_data]
+                if missing:
+                    logger.error(f"Campi richiesti mancanti: {missing}")
+                    continue
+                if not position_data.get('liquidation_price'):
+                    logger.warning(f"Liquidation price non disponibile per la posizione {position_data['position_id']}")
+                valid.append(position_data)
+            
+            if not valid:
+                return 0
+            
+            result = self.positions.insert_many(valid, ordered=False)
+            logger.info(f"Posizioni salvate: {[p['position_id'] for p in valid]}")
+            return len(result.inserted_ids)
+            
+        except BulkWriteError as e:
+            inserted = e.details.get('nInserted', 0)
+            logger.error(f"Errore salvataggio posizioni ({inserted} inserite): {e.details.get('writeErrors')}")
+            return inserted
+        except Exception as e:
+            logger.error(f"Errore salvataggio posizioni: {e}")
+            return 0
+    
     def get_user_open_positions(self, user_id):
         """
         Recupera tutte le posizioni aperte per un utente
@@ -559,7 +693,7 @@ class PositionManager:
             logger.error(f"Errore recupero posizioni bot: {e}")
             return []
     
-    def get_bot_open_positions(self, bot_id):
+    def get_bot_open_positions(self, bot_id, projection=None):
         """
         Recupera solo le posizioni aperte di un bot specifico - OTTIMIZZATO
         
@@ -568,6 +702,7 @@ class PositionManager:
         
         Args:
             bot_id: ID del bot
+            projection: Campi da restituire (opzionale, default tutti)
             
         Returns:
             list: Lista delle posizioni aperte del bot
@@ -576,7 +711,7 @@ class PositionManager:
             positions = list(self.positions.find({
                 "bot_id": bot_id,
                 "status": "open"
-            }))
+            }, projection=projection))
             
             logger.info(f"Trovate {len(positions)} posizioni aperte per bot {bot_id}")
             return positions
@@ -585,6 +720,33 @@ class PositionManager:
             logger.error(f"Errore recupero posizioni aperte bot: {e}")
             return []
     
+    def get_open_positions_for_bots(self, bot_ids, projection=None):
+        """
+        Recupera con una sola query le posizioni aperte di più bot
+        
+        Args:
+            bot_ids: ID dei bot
+            projection: Campi da restituire (opzionale, default tutti; bot_id è sempre incluso)
+            
+        Returns:
+            dict: {bot_id: lista delle posizioni aperte} (bot senza posizioni assenti),
+                None in caso di errore
+        """
+        try:
+            positions_by_bot = {}
+            if projection is not None:
+                projection = {**dict.fromkeys(projection, 1), "bot_id": 1}
+            
+            for position in self.positions.find({"bot_id": {"$in": list(bot_ids)}, "status": "open"}, projection=projection):
+                positions_by_bot.setdefault(position["bot_id"], []).append(position)
+            
+            logger.info(f"Trovate posizioni aperte per {len(positions_by_bot)} bot su {len(bot_ids)}")
+            return positions_by_bot
+            
+        except Exception as e:
+            logger.error(f"Errore recupero posizioni aperte bot: {e}")
+            return None
+    
     def update_position_status(self, position_id, status, close_data=None):
         """
         Aggiorna lo status di una posizione
@@ -598,19 +760,7 @@ class PositionManager:
             bool: True se aggiornata con successo
         """
         try:
-            update_data = {
-                "status": status
-            }
-            
-            # Se stiamo chiudendo, aggiungi dati di chiusura
-            if status == "closed" and close_data:
-                update_data.update({
-                    "closed_at": datetime.utcnow(),
-                    "close_price": close_data.get("close_price"),
-                    "realized_pnl": close_data.get("realized_pnl")
-                })
-                if close_data.get("close_reason") is not None:
-                    update_data["close_reason"] = close_data.get("close_reason")
+            update_data = self._status_update_data(status, close_data)
             
             result = self.positions.update_one(
                 {"position_id": position_id},
@@ -628,6 +778,61 @@ class PositionManager:
             logger.error(f"Errore aggiornamento posizione: {e}")
             return False
     
+    def _status_update_data(self, status, close_data=None):
+        """Costruisce i campi da aggiornare per un cambio di status della posizione"""
+        update_data = {
+            "status": status
+        }
+        
+        # Se stiamo chiudendo, aggiungi dati di chiusura
+        if status == "closed" and close_data:
+            update_data.update({
+                "closed_at": datetime.utcnow(),
+                "close_price": close_data.get("close_price"),
+                "realized_pnl": close_data.get("realized_pnl")
+            })
+            if close_data.get("close_reason") is not None:
+                update_data["close_reason"] = close_data.get("close_reason")
+        
+        return update_data
+    
+    def position_status_update(self, position_id, status, close_data=None):
+        """
+        Prepara l'aggiornamento di status di una posizione per bulk_update_positions
+        
+        Args:
+            position_id: ID della posizione
+            status: Nuovo status ("open", "closed", "error")
+            close_data: Dati di chiusura opzionali
+            
+        Returns:
+            UpdateOne: Operazione da eseguire
+        """
+        return UpdateOne({"position_id": position_id}, {"$set": self._status_update_data(status, close_data)})
+    
+    def bulk_update_positions(self, operations):
+        """
+        Esegue più aggiornamenti di posizioni con un solo round trip
+        
+        Args:
+            operations: Lista di UpdateOne (es. da position_status_update)
+            
+        Returns:
+            int: Numero di posizioni modificate
+        """
+        if not operations:
+            return 0
+        
+        try:
+            # ordered=False: gli aggiornamenti sono indipendenti, un errore non blocca gli altri
+            result = self.positions.bulk_write(operations, ordered=False)
+            logger.info(f"{result.modified_count}/{len(operations)} posizioni aggiornate")
+            return result.modified_count
+            
+        except Exception as e:
+            logger.error(f"Errore aggiornamento posizioni in blocco: {e}")
+            return 0
+    
     def close_all_user_positions(self, user_id, close_reason="manual"):
         """
         Chiude tutte le posizioni aperte di un utente
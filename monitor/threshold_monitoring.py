@@ -201,37 +201,7 @@ class ThresholdMonitor:
             float: Liquidation price o None se non disponibile
         """
         try:
-            # Verifica che l'exchange sia inizializzato
-            if exchange_name not in exchange_manager.exchanges:
-                return None
-            
-            exchange = exchange_manager.exchanges[exchange_name]
-            
-            # Per BitMEX usa logica specifica con fetch_positions()
-            if exchange_name.lower() == 'bitmex':
-                positions = exchange.fetch_positions()
-                for pos in positions:
-                    # BitMEX usa 'contracts' invece di 'size'
-                    contracts = pos.get('contracts', 0)
-                    size = pos.get('size', 0)
-                    
-                    if (pos.get('symbol') == symbol and 
-                        (contracts != 0 or size != 0) and
-                        pos.get('side', '').lower() == side.lower()):
-                        
-                        liquidation_price = pos.get('liquidationPrice')
-                        if liquidation_price:
-                            print(f"Liquidation price recuperato da {exchange_name}: {liquidation_price}")
-                            return float(liquidation_price)
-            else:
-                # Altri exchange: usa exchange_manager.get_position() (metodo testato)
-                position = exchange_manager.get_position(exchange_name)
-                if position and position.get('liquidationPrice'):
-                    liquidation_price = float(position['liquidationPrice'])
-                    print(f"Liquidation price recuperato da {exchange_name}: {liquidation_price}")
-                    return liquidation_price
-            
-            return None
+            return exchange_manager.get_liquidation_price(exchange_name, symbol, side)
             
         except Exception as e:
             print(f"Errore recupero liquidation price da {exchange_name}: {e}")
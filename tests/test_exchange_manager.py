@@ -0,0 +1,117 @@
+"""Test della chiusura posizioni in ExchangeManager con client CCXT bitmex stubbato"""
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+import ccxt
+
+from trading.exchange_manager import ExchangeManager
+
+
+def _bitmex_client(positions):
+    """Client ccxt.bitmex reale con le chiamate di rete sostituite da mock"""
+    exchange = ccxt.bitmex()
+    exchange.fetch_positions = MagicMock(return_value=positions)
+    exchange.create_market_order = MagicMock(side_effect=lambda symbol, side, amount, *args: {
+        'id': f'close-{symbol}', 'symbol': symbol, 'side': side, 'amount': amount})
+    return exchange
+
+
+class TestBitmexClose(unittest.TestCase):
+    
+    def test_close_uses_market_order_even_if_has_close_position(self):
+        # ccxt dichiara closePosition per bitmex ma non implementa close_position
+        exchange = _bitmex_client([
+            {'symbol': 'SOL/USDT:USDT', 'side': 'long', 'contracts': 300},
+        ])
+        self.assertTrue(exchange.has.get('closePosition'))
+        
+        manager = ExchangeManager()
+        manager.exchanges['bitmex'] = exchange
+        result = manager.close_position('bitmex')
+        
+        self.assertTrue(result['success'])
+        self.assertEqual(result['message'], 'position_closed')
+        exchange.create_market_order.assert_called_once_with(symbol='SOL/USDT:USDT', side='sell', amount=300)
+    
+    def test_close_multiple_positions_one_order_each(self):
+        exchange = _bitmex_client([
+            {'symbol': 'SOL/USDT:USDT', 'side': 'long', 'contracts': 300},
+            {'symbol': 'ETH/USDT:USDT', 'side': 'short', 'contracts': 20},
+        ])
+        
+        manager = ExchangeManager()
+        manager.exchanges['bitmex'] = exchange
+        result = manager.close_position('bitmex')
+        
+        self.assertTrue(result['success'])
+        self.assertEqual(len(result['order']), 2)
+        exchange.create_market_order.assert_any_call(symbol='SOL/USDT:USDT', side='sell', amount=300)
+        exchange.create_market_order.assert_any_call(symbol='ETH/USDT:USDT', side='buy', amount=20)
+    
+    def test_close_without_open_positions(self):
+        exchange = _bitmex_client([{'symbol': 'SOL/USDT:USDT', 'side': 'long', 'contracts': 0}])
+        
+        manager = ExchangeManager()
+        manager.exchanges['bitmex'] = exchange
+        result = manager.close_position('bitmex')
+        
+        self.assertEqual(result['message'], 'no_position')
+        exchange.create_market_order.assert_not_called()
+
+    
+    def test_strict_close_does_not_fall_back_to_account_close(self):
+        exchange = _bitmex_client([
+            {'symbol': 'SOL/USDT:USDT', 'side': 'long', 'contracts': 300},
+            {'symbol': 'ETH/USDT:USDT', 'side': 'short', 'contracts': 20},
+        ])
+        exchange.create_market_order = MagicMock(side_effect=ccxt.InvalidOrder('reduce-only rejected'))
+        
+        manager = ExchangeManager()
+        manager.exchanges['bitmex'] = exchange
+        result = manager.close_position('bitmex', {'symbol': 'SOL/USDT:USDT', 'side': 'long', 'size': 100}, strict=True)
+        
+        self.assertFalse(result['success'])
+        exchange.fetch_positions.assert_not_called()
+        exchange.create_market_order.assert_called_once_with('SOL/USDT:USDT', 'sell', 100.0, None, {'reduceOnly': True})
+
+
+
+class TestClientCache(unittest.TestCase):
+    
+    def setUp(self):
+        # Mercati già in cache: initialize_exchange non fa chiamate di rete
+        ExchangeManager._markets_cache['bitmex'] = ({}, {})
+        ExchangeManager._client_cache.clear()
+    
+    def tearDown(self):
+        ExchangeManager._markets_cache.pop('bitmex', None)
+        ExchangeManager._client_cache.clear()
+    
+    def _client_in_new_thread(self):
+        clients = []
+        
+        def init():
+            manager = ExchangeManager()
+            manager.initialize_exchange('bitmex', 'key', 'secret')
+            clients.append(manager.exchanges['bitmex'])
+        
+        thread = threading.Thread(target=init)
+        thread.start()
+        thread.join()
+        return clients[0]
+    
+    def test_client_reused_by_same_thread(self):
+        first, second = ExchangeManager(), ExchangeManager()
+        self.assertTrue(first.initialize_exchange('bitmex', 'key', 'secret'))
+        self.assertTrue(second.initialize_exchange('bitmex', 'key', 'secret'))
+        self.assertIs(first.exchanges['bitmex'], second.exchanges['bitmex'])
+    
+    def test_client_not_shared_across_threads(self):
+        manager = ExchangeManager()
+        manager.initialize_exchange('bitmex', 'key', 'secret')
+        self.assertIsNot(manager.exchanges['bitmex'], self._client_in_new_thread())
+
+
+if __name__ == '__main__':
+    unittest.main()
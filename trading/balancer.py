@@ -16,136 +16,292 @@ Funzionalità:
 """
 
 import logging
+import threading
 import time
 import hmac
-import hashlib
 import json
 import requests
-from typing import Dict, List, Optional, Tuple
-from datetime import datetime
+from collections import defaultdict
+from itertools import islice
+from types import MappingProxyType
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, Iterator, List, Optional, Tuple
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from database.models import bot_manager, position_manager, user_manager
-from trading.exchange_manager import exchange_manager
+from trading.exchange_manager import ExchangeManager
+from utils.exchange_utils import ExchangeUtils
 from config.settings import BOT_STATUS
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Numero massimo di bot processati in parallelo
+MAX_WORKERS = 8
+
+# Timeout (connessione, lettura) in secondi per le chiamate REST dirette
+HTTP_TIMEOUT = (3.05, 27)
+
+# Endpoint REST Bitfinex firmati (il path firmato è "/api" + path)
+BITFINEX_API_URL = "https://api.bitfinex.com"
+BITFINEX_COLLATERAL_SET_PATH = "/v2/auth/w/deriv/collateral/set"
+BITFINEX_COLLATERAL_ATTEMPTS = 2
+
+# Simboli derivati Bitfinex (formato posizione -> formato API)
+_BFX_SYMBOL_MAP = MappingProxyType({
+    "SOL/USDT:USDT": "tSOLF0:USTF0",
+    "SOL/USDT": "tSOLF0:USTF0",
+    "BTC/USDT:USDT": "tBTCF0:USTF0",
+    "BTC/USDT": "tBTCF0:USTF0",
+    "ETH/USDT:USDT": "tETHF0:USTF0",
+    "ETH/USDT": "tETHF0:USTF0"
+})
+
+# Simboli BitMEX: suffisso per valuta di quotazione e cache delle conversioni
+_BITMEX_QUOTE_SUFFIX = MappingProxyType({"USDT": "USDT", "USD": "USD"})
+_BITMEX_SYMBOL_CACHE: Dict[str, str] = {}
+
+# BitMEX esprime i margini USDT in Satoshi: 1 USDT = 1,000,000 Satoshi USDT
+USDT_SATOSHI = 1_000_000
+
+# Validità (secondi) del margine massimo rimovibile BitMEX già recuperato
+MAX_REMOVABLE_TTL = 1.0
+
+# Wallet Bitfinex considerati nel recupero dei saldi
+_WALLET_TYPES = frozenset(('exchange', 'margin', 'funding'))
+
+# Lettura dei bot dal database: documenti per batch e soli campi usati da process_bot
+BOT_BATCH_SIZE = 64
+BOT_PROJECTION = {"user_id": 1, "leverage": 1, "status": 1, "transfer_reason": 1}
+
+# Segno della posizione per i confronti di prezzo (long = +1, short = -1)
+SIDE_SIGN = {"long": 1.0, "short": -1.0}
+
+# Collaterale minimo Bitfinex per evitare l'errore "collateral: insufficient"
+BITFINEX_MIN_COLLATERAL = 0.05
+
+# Verifica della leva dopo l'aggiustamento del collaterale Bitfinex:
+# attese progressive (secondi) e differenza minima di margine (USDT) per eseguirla
+BITFINEX_VERIFY_DELAYS = (0.25, 0.5, 1.0)
+BITFINEX_VERIFY_MIN_MARGIN_DIFF = 5.0
+
+
+# Campi margine della posizione CCXT, in ordine di priorità
+_MARGIN_KEYS = ('collateral', 'margin', 'initialMargin')
+_BITMEX_MARGIN_KEYS = ('initialMargin', 'collateral', 'maintenanceMargin')
+_BITMEX_INFO_MARGIN_KEYS = ('posMargin', 'posInit', 'initMargin')
+
+
+def _first_nonzero(d: Dict, keys: Tuple[str, ...], default=0):
+    """Restituisce il primo valore non nullo di d tra le chiavi indicate, altrimenti default"""
+    for key in keys:
+        value = d.get(key)
+        if value:
+            return value
+    return default
+
+
+def _satoshi_to_int(raw) -> int:
+    """Converte un valore in Satoshi (numero o stringa) in intero, 0 se mancante o non valido"""
+    # BitMEX restituisce normalmente numeri interi JSON: nessuna conversione
+    if isinstance(raw, int):
+        return raw
+    try:
+        return int(raw or 0)
+    except (ValueError, TypeError):
+        return 0
+
+
+def _next_nonce() -> str:
+    """Nonce Bitfinex strettamente crescente anche tra thread concorrenti
+    
+    Usa lo stesso contatore dei client CCXT, che firmano con le stesse API keys.
+    """
+    return str(ExchangeUtils.get_bitfinex_nonce())
+
+
+def _to_bitmex(symbol: str) -> str:
+    """Converte un simbolo CCXT (es. "SOL/USDT:USDT") nel formato BitMEX (es. "SOLUSDT")
+    
+    I simboli già in formato BitMEX (senza '/') sono restituiti invariati.
+    """
+    converted = _BITMEX_SYMBOL_CACHE.get(symbol)
+    if converted is None:
+        base, sep, rest = symbol.partition('/')
+        if sep:
+            quote = rest.partition(':')[0]
+            converted = base + _BITMEX_QUOTE_SUFFIX.get(quote, quote)
+        else:
+            converted = symbol
+        _BITMEX_SYMBOL_CACHE[symbol] = converted
+    return converted
+
+
+def leverage_for_margin(nominal_value: float, margin: float) -> float:
+    """Leva effettiva: valore nominale / margine"""
+    return nominal_value / margin
+
+
+def margin_for_leverage(nominal_value: float, target_leverage: float, unrealized_pnl: float = 0.0) -> float:
+    """Margine necessario per la leva target, al netto del PnL non realizzato"""
+    return nominal_value / target_leverage - unrealized_pnl
+
+
+def satoshi_amount(usdt: float) -> int:
+    """Importo USDT convertito in Satoshi USDT, arrotondato all'intero più vicino"""
+    return round(usdt * USDT_SATOSHI)
+
+
+def within_tolerance(current: float, target: float, tolerance: float) -> bool:
+    """True se current dista da target meno della tolleranza"""
+    return abs(current - target) < tolerance
+
+
+@dataclass(slots=True, frozen=True)
+class NormalizedPosition:
+    """Campi di una posizione exchange estratti una sola volta per i calcoli di leva/margine"""
+    exchange: str
+    symbol: str
+    side: str
+    size: float            # Bitfinex: size in SOL; BitMEX: notional in USDT
+    margin: float          # Margine/collaterale in USDT
+    entry_price: float
+    unrealized_pnl: float
+
 class Balancer:
     """Classe che gestisce il monitoraggio e il ribilanciamento della leva finanziaria
     per i bot con stato "running"
     """
     
+    # Valori di stato risolti una sola volta a livello di classe
+    STATUS_RUNNING = BOT_STATUS["RUNNING"]
+    STATUS_TRANSFERING = BOT_STATUS["TRANSFERING"]
+    STATUS_STOPPED = BOT_STATUS["STOPPED"]
+    STATUS_TRANSFER_REQUESTED = BOT_STATUS["TRANSFER_REQUESTED"]
+    STATUS_EXTERNAL_TRANSFER_PENDING = BOT_STATUS["EXTERNAL_TRANSFER_PENDING"]
+    STATUS_STOP_REQUESTED = BOT_STATUS["STOP_REQUESTED"]
+    
     def __init__(self):
         """Inizializza il balancer"""
-        pass
+        # Sessione HTTP condivisa (keep-alive) per le chiamate REST firmate dirette
+        self._http = requests.Session()
+        # Retry solo su errori di connessione e 502/503/504 (i POST non vengono ripetuti sullo status)
+        self._http.mount("https://", HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=16,
+            max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        ))
+        # ExchangeManager per thread: ogni worker usa le API keys del proprio bot
+        self._local = threading.local()
+        # Margine massimo rimovibile BitMEX per (impronta credenziali, simbolo): (istante monotonic, valore)
+        self._max_removable_cache: Dict[Tuple[Tuple[str, str], str], Tuple[float, Optional[float]]] = {}
+        self._max_removable_lock = threading.Lock()
+    
+    def _sign_bitfinex(self, api_secret_bytes: bytes, path: str, body_bytes: bytes) -> Tuple[str, str]:
+        """Genera nonce e firma HMAC-SHA384 one-shot per una richiesta Bitfinex
+        
+        Args:
+            api_secret_bytes: API secret di Bitfinex già codificato
+            path: Path dell'endpoint (senza il prefisso "/api")
+            body_bytes: Body della richiesta già serializzato
+            
+        Returns:
+            Tupla (nonce, firma esadecimale)
+        """
+        nonce = _next_nonce()
+        message = f"/api{path}{nonce}".encode('utf-8') + body_bytes
+        return nonce, hmac.digest(api_secret_bytes, message, 'sha384').hex()
+    
+    @property
+    def exchange_manager(self) -> ExchangeManager:
+        """ExchangeManager del thread corrente (creato alla prima richiesta)"""
+        manager = getattr(self._local, "exchange_manager", None)
+        if manager is None:
+            manager = ExchangeManager()
+            self._local.exchange_manager = manager
+        return manager
     
     def run(self):
         """Esegue il monitoraggio per cercare bot processabili e ribilancia la leva"""
         logger.info("=== INIZIO CICLO BALANCER ===")
-        start_time = datetime.now()
+        start_time = time.perf_counter()
         
         try:
-            # Recupera tutti i bot dal database
-            all_bots = self.get_all_bots()
-            
-            # Filtra i bot processabili secondo la logica degli stati
-            processable_bots = self.filter_processable_bots(all_bots)
-            
-            if processable_bots:
-                logger.info(f"Trovati {len(processable_bots)} bot da processare su {len(all_bots)} totali")
-                # Processa ogni bot
-                for bot in processable_bots:
-                    self.process_bot(bot)
+            # Legge i bot processabili in streaming dal cursore a blocchi di BOT_BATCH_SIZE
+            # e li processa in parallelo (tempo dominato dalle attese HTTP): il blocco
+            # successivo viene letto solo dopo il completamento del precedente
+            processed_bots = 0
+            bots_with_keys = self.iter_bots_with_api_keys()
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                while True:
+                    batch = list(islice(bots_with_keys, BOT_BATCH_SIZE))
+                    if not batch:
+                        break
+                    futures = [executor.submit(self.process_bot, bot, api_keys) for bot, api_keys in batch]
+                    for future in as_completed(futures):
+                        future.result()
+                        processed_bots += 1
+            
+            if processed_bots:
+                logger.info(f"Processati {processed_bots} bot")
             else:
-                logger.info(f"Nessun bot da processare trovato su {len(all_bots)} totali")
+                logger.info("Nessun bot da processare trovato")
             
             # Log di completamento
-            end_time = datetime.now()
-            duration = (end_time - start_time).total_seconds()
+            duration = time.perf_counter() - start_time
             logger.info(f"=== FINE CICLO BALANCER === (durata: {duration:.2f}s)")
             
         except Exception as e:
             logger.error(f"Errore nel ciclo di monitoraggio: {e}")
-            end_time = datetime.now()
-            duration = (end_time - start_time).total_seconds()
+            duration = time.perf_counter() - start_time
             logger.error(f"=== CICLO BALANCER INTERROTTO === (durata: {duration:.2f}s)")
     
-    def get_all_bots(self) -> List[Dict]:
-        """Recupera tutti i bot dal database"""
-        try:
-            return list(bot_manager.bots.find({}))
-        except Exception as e:
-            logger.error(f"Errore recupero bot: {e}")
-            return []
-    
-    def filter_processable_bots(self, all_bots: List[Dict]) -> List[Dict]:
-        """Filtra i bot processabili secondo la logica degli stati
+    def iter_processable_bots(self) -> Iterator[Dict]:
+        """Restituisce in streaming i bot processabili, filtrati lato database
         
         Bot processabili:
         - RUNNING: sempre processabile
         - TRANSFERING con transfer_reason = "rebalance": processabile
         
-        Bot NON processabili:
-        - STOPPED: bot fermato
-        - TRANSFER_REQUESTED: in attesa di trasferimento interno
-        - EXTERNAL_TRANSFER_PENDING: in attesa di trasferimento esterno
-        - TRANSFERING con transfer_reason diverso da "rebalance"
-        - Altri stati
+        Tutti gli altri stati (STOPPED, TRANSFER_REQUESTED, EXTERNAL_TRANSFER_PENDING,
+        TRANSFERING con altro motivo, ...) sono esclusi dalla query.
         """
-        processable_bots = []
-        skipped_count = {"stopped": 0, "transfer_requested": 0, "external_transfer_pending": 0, "transfering_other": 0, "other": 0}
+        query = {"$or": [
+            {"status": self.STATUS_RUNNING},
+            {"status": self.STATUS_TRANSFERING, "transfer_reason": "rebalance"}
+        ]}
+        try:
+            cursor = bot_manager.bots.find(query, projection=BOT_PROJECTION).batch_size(BOT_BATCH_SIZE)
+            for bot in cursor:
+                yield bot
+        except Exception as e:
+            logger.error(f"Errore recupero bot: {e}")
+    
+    def iter_bots_with_api_keys(self) -> Iterator[Tuple[Dict, Dict]]:
+        """Restituisce i bot processabili con le API keys dei rispettivi utenti
         
-        for bot in all_bots:
-            bot_id = bot.get("_id")
-            status = bot.get("status")
-            transfer_reason = bot.get("transfer_reason")
-            
-            # Stati critici - NON processare
-            if status == BOT_STATUS["STOPPED"]:
-                logger.debug(f"Bot {bot_id}: saltato (stato: STOPPED)")
-                skipped_count["stopped"] += 1
-                continue
-            elif status == BOT_STATUS["TRANSFER_REQUESTED"]:
-                logger.debug(f"Bot {bot_id}: saltato (stato: TRANSFER_REQUESTED)")
-                skipped_count["transfer_requested"] += 1
-                continue
-            elif status == BOT_STATUS["EXTERNAL_TRANSFER_PENDING"]:
-                logger.debug(f"Bot {bot_id}: saltato (stato: EXTERNAL_TRANSFER_PENDING)")
-                skipped_count["external_transfer_pending"] += 1
-                continue
-            elif status == BOT_STATUS["TRANSFERING"] and transfer_reason != "rebalance":
-                logger.debug(f"Bot {bot_id}: saltato (stato: TRANSFERING, motivo: {transfer_reason})")
-                skipped_count["transfering_other"] += 1
-                continue
+        Le API keys sono caricate con una sola query per ogni batch di BOT_BATCH_SIZE bot;
+        per gli utenti non trovati nel batch process_bot le ricarica singolarmente.
+        """
+        bots = self.iter_processable_bots()
+        while True:
+            batch = list(islice(bots, BOT_BATCH_SIZE))
+            if not batch:
+                return
             
-            # Stati processabili
-            elif status == BOT_STATUS["RUNNING"]:
-                logger.debug(f"Bot {bot_id}: processabile (stato: RUNNING)")
-                processable_bots.append(bot)
-            elif status == BOT_STATUS["TRANSFERING"] and transfer_reason == "rebalance":
-                logger.debug(f"Bot {bot_id}: processabile (stato: TRANSFERING, motivo: rebalance)")
-                processable_bots.append(bot)
-            elif status == BOT_STATUS["EXTERNAL_TRANSFER_PENDING"] and transfer_reason == "rebalance":
-                logger.debug(f"Bot {bot_id}: processabile (stato: EXTERNAL_TRANSFER_PENDING, motivo: rebalance)")
-                processable_bots.append(bot)
-            else:
-                logger.debug(f"Bot {bot_id}: saltato (stato sconosciuto: {status})")
-                skipped_count["other"] += 1
-        
-        # Log riassuntivo
-        if any(skipped_count.values()):
-            skipped_details = [f"{reason}: {count}" for reason, count in skipped_count.items() if count > 0]
-            logger.info(f"Bot saltati: {skipped_details}")
-        
-        return processable_bots
+            api_keys_by_user = user_manager.get_users_api_keys([bot.get("user_id") for bot in batch])
+            for bot in batch:
+                yield bot, api_keys_by_user.get(str(bot.get("user_id")))
     
-    def process_bot(self, bot: Dict):
+    def process_bot(self, bot: Dict, api_keys: Optional[Dict] = None):
         """Processa un bot con stato "running"
         
         Args:
             bot: Dati del bot da processare
+            api_keys: API keys dell'utente già caricate (se None vengono recuperate dal database)
         """
         try:
             user_id = bot["user_id"]
@@ -162,8 +318,7 @@ class Balancer:
             logger.info(f"Processando bot {bot_id} con leva target {target_leverage}X")
             
             # Recupera posizioni aperte per questo bot
-            bot_positions = position_manager.get_bot_positions(bot_id)
-            open_positions = [p for p in bot_positions if p["status"] == "open"]
+            open_positions = position_manager.get_bot_open_positions(bot_id)
             
             if not open_positions:
                 logger.info(f"Nessuna posizione aperta per bot {bot_id}")
@@ -171,8 +326,9 @@ class Balancer:
             
             logger.info(f"Trovate {len(open_positions)} posizioni aperte per bot {bot_id}")
             
-            # Recupera API keys dell'utente
-            api_keys = user_manager.get_user_api_keys(user_id)
+            # Recupera API keys dell'utente se non già caricate per il ciclo
+            if api_keys is None:
+                api_keys = user_manager.get_user_api_keys(user_id)
             if not api_keys:
                 logger.error(f"API keys non trovate per utente {user_id}")
                 return
@@ -187,47 +343,18 @@ class Balancer:
                 logger.info(f"Consolidamento wallet completato per bot {bot_id}")
             
             # Inizializza gli exchange necessari
-            exchanges_to_init = set(pos["exchange"] for pos in open_positions)
-            initialized_exchanges = set()
-            
-            for exchange_name in exchanges_to_init:
-                api_key = api_keys.get(f"{exchange_name}_api_key")
-                api_secret = api_keys.get(f"{exchange_name}_api_secret")
-                
-                if not api_key or not api_secret:
-                    logger.warning(f"API keys mancanti per {exchange_name}")
-                    continue
-                
-                success = exchange_manager.initialize_exchange(
-                    exchange_name,
-                    api_key,
-                    api_secret
-                )
-                
-                if success:
-                    initialized_exchanges.add(exchange_name)
-                    logger.info(f"Exchange {exchange_name} inizializzato con successo")
-                else:
-                    logger.error(f"Impossibile inizializzare {exchange_name}")
+            exchanges_to_init = {pos["exchange"] for pos in open_positions}
+            initialized_exchanges = self.initialize_exchanges(exchanges_to_init, api_keys)
 
             # Safety check dedicato per stato EXTERNAL_TRANSFER_PENDING con motivo rebalance
-            if current_status == BOT_STATUS["EXTERNAL_TRANSFER_PENDING"] and transfer_reason == "rebalance":
+            if current_status == self.STATUS_EXTERNAL_TRANSFER_PENDING and transfer_reason == "rebalance":
                 try:
-                    danger = False
-                    for position in open_positions:
-                        safety_value = position.get("safety_value")
-                        side = position.get("side")
-                        ex = position.get("exchange")
-                        if safety_value is None or side is None or ex not in initialized_exchanges:
-                            continue
-                        current_price = exchange_manager.get_solana_price(ex)
-                        if current_price is None:
-                            continue
-                        if (side == "long" and current_price < safety_value) or (side == "short" and current_price > safety_value):
-                            danger = True
-                            break
-                    if danger:
-                        bot_manager.update_bot_status(user_id, BOT_STATUS["STOP_REQUESTED"], stopped_type="safety", transfer_reason="emergency_close")
+                    # Un solo prezzo per exchange, poi confronto con le safety delle posizioni
+                    price_by_exchange = self.fetch_prices_by_exchange(
+                        {p.get("exchange") for p in open_positions} & initialized_exchanges
+                    )
+                    if self.is_safety_triggered(open_positions, price_by_exchange):
+                        bot_manager.update_bot_status(user_id, self.STATUS_STOP_REQUESTED, stopped_type="safety", transfer_reason="emergency_close")
                         logger.info(f"Bot {bot_id}: safety trigger in EXTERNAL_TRANSFER_PENDING → STOP_REQUESTED")
                     else:
                         logger.info(f"Bot {bot_id}: safety OK in EXTERNAL_TRANSFER_PENDING (rebalance)")
@@ -235,51 +362,214 @@ class Balancer:
                     logger.error(f"Errore safety check per bot {bot_id}: {e}")
                 return
             
-            # Analizza e ribilancia le posizioni
+            # Recupera le posizioni una sola volta per exchange (indicizzate per simbolo)
+            positions_by_exchange = self.fetch_open_positions_by_exchange(initialized_exchanges)
+            
+            # Recupera il prezzo corrente una sola volta per exchange
+            price_by_exchange = self.fetch_prices_by_exchange(positions_by_exchange)
+            
+            # Raggruppa le posizioni per exchange
             all_positions_success = True
             processed_positions = 0
+            positions_by_exchange_name = defaultdict(list)
             
             for position in open_positions:
-                try:
-                    exchange_name = position["exchange"]
-                    
-                    # Verifica che l'exchange sia stato inizializzato
-                    if exchange_name not in initialized_exchanges:
-                        logger.warning(f"Exchange {exchange_name} non inizializzato, salto posizione")
-                        all_positions_success = False
-                        continue
-                    
-                    # Analizza la posizione e calcola la leva effettiva
-                    position_success = self.analyze_and_balance_position(position, target_leverage, api_keys)
-                    
-                    if position_success:
-                        processed_positions += 1
-                    else:
-                        all_positions_success = False
-                    
-                except Exception as e:
-                    logger.error(f"Errore nel processare posizione {position.get('position_id')}: {e}")
+                exchange_name = position.get("exchange")
+                
+                # Verifica che l'exchange sia stato inizializzato
+                if exchange_name not in initialized_exchanges:
+                    logger.warning(f"Exchange {exchange_name} non inizializzato, salto posizione")
                     all_positions_success = False
+                    continue
+                positions_by_exchange_name[exchange_name].append(position)
+            
+            # Analizza e ribilancia in parallelo tra exchange diversi (chiamate di rete indipendenti);
+            # le posizioni dello stesso exchange restano sequenziali sullo stesso client
+            if positions_by_exchange_name:
+                manager = self.exchange_manager
+                with ThreadPoolExecutor(max_workers=len(positions_by_exchange_name)) as executor:
+                    futures = [
+                        executor.submit(self.balance_exchange_positions, manager, exchange_positions, target_leverage,
+                                        api_keys, positions_by_exchange, price_by_exchange)
+                        for exchange_positions in positions_by_exchange_name.values()
+                    ]
+                    for future in as_completed(futures):
+                        exchange_processed, exchange_success = future.result()
+                        processed_positions += exchange_processed
+                        all_positions_success = all_positions_success and exchange_success
             
             # Gestisci aggiornamento stato in base al risultato delle operazioni
             current_status = bot.get("status")
-            if current_status == BOT_STATUS["TRANSFERING"] and all_positions_success and processed_positions > 0:
-                self.update_bot_status_to_running(user_id, bot_id, processed_positions)
-            elif current_status == BOT_STATUS["TRANSFERING"] and not all_positions_success:
+            if current_status == self.STATUS_TRANSFERING and all_positions_success and processed_positions > 0:
+                self.update_bot_status_to_running(user_id, bot_id, processed_positions, current_status)
+            elif current_status == self.STATUS_TRANSFERING and not all_positions_success:
                 logger.info(f"Bot {bot_id} rimane in stato TRANSFERING - alcune operazioni di balancing non sono riuscite")
-            elif current_status == BOT_STATUS["RUNNING"] and all_positions_success and processed_positions > 0:
+            elif current_status == self.STATUS_RUNNING and all_positions_success and processed_positions > 0:
                 logger.info(f"✅ Bot {bot_id} processato con successo - {processed_positions} posizioni bilanciate (stato: RUNNING)")
             
         except Exception as e:
             logger.error(f"Errore nel processare bot {bot.get('_id')}: {e}")
     
-    def analyze_and_balance_position(self, position: Dict, target_leverage: float, api_keys: Dict) -> bool:
+    def balance_exchange_positions(self, manager: ExchangeManager, positions: List[Dict], target_leverage: float,
+                                   api_keys: Dict, positions_by_exchange: Dict[str, Dict[str, Dict]],
+                                   price_by_exchange: Dict[str, float]) -> Tuple[int, bool]:
+        """Analizza e ribilancia in sequenza le posizioni di un singolo exchange
+        
+        Eseguito in un worker: usa l'ExchangeManager del thread che processa il bot.
+        
+        Args:
+            manager: ExchangeManager già inizializzato del bot
+            positions: Posizioni del database sullo stesso exchange
+            target_leverage: Leva target
+            api_keys: API keys dell'utente
+            positions_by_exchange: Posizioni exchange già recuperate
+            price_by_exchange: Prezzi correnti per exchange
+            
+        Returns:
+            Tupla (posizioni processate con successo, True se tutte riuscite)
+        """
+        self._local.exchange_manager = manager
+        
+        processed_positions = 0
+        all_positions_success = True
+        
+        for position in positions:
+            try:
+                # Analizza la posizione e calcola la leva effettiva
+                position_success = self.analyze_and_balance_position(position, target_leverage, api_keys, positions_by_exchange, price_by_exchange)
+                
+                if position_success:
+                    processed_positions += 1
+                else:
+                    all_positions_success = False
+                
+            except Exception as e:
+                logger.error(f"Errore nel processare posizione {position.get('position_id')}: {e}")
+                all_positions_success = False
+        
+        return processed_positions, all_positions_success
+    
+    def initialize_exchanges(self, exchange_names, api_keys: Dict) -> set:
+        """Inizializza in parallelo gli exchange richiesti (TLS handshake e load_markets si sovrappongono)
+        
+        Args:
+            exchange_names: Nomi degli exchange da inizializzare
+            api_keys: API keys dell'utente
+            
+        Returns:
+            Set degli exchange inizializzati con successo
+        """
+        # L'ExchangeManager è per-thread: va risolto qui e non nei worker
+        manager = self.exchange_manager
+        
+        to_init = []
+        for exchange_name in exchange_names:
+            api_key = api_keys.get(f"{exchange_name}_api_key")
+            api_secret = api_keys.get(f"{exchange_name}_api_secret")
+            
+            if not api_key or not api_secret:
+                logger.warning(f"API keys mancanti per {exchange_name}")
+                continue
+            to_init.append((exchange_name, api_key, api_secret))
+        
+        if not to_init:
+            return set()
+        
+        with ThreadPoolExecutor(max_workers=len(to_init)) as executor:
+            results = list(executor.map(lambda args: (args[0], manager.initialize_exchange(*args)), to_init))
+        
+        initialized_exchanges = set()
+        for exchange_name, success in results:
+            if success:
+                initialized_exchanges.add(exchange_name)
+                logger.info(f"Exchange {exchange_name} inizializzato con successo")
+            else:
+                logger.error(f"Impossibile inizializzare {exchange_name}")
+        
+        return initialized_exchanges
+    
+    def fetch_open_positions_by_exchange(self, exchange_names) -> Dict[str, Dict[str, Dict]]:
+        """Recupera le posizioni aperte con una sola chiamata fetch_positions per exchange
+        
+        Args:
+            exchange_names: Exchange già inizializzati
+            
+        Returns:
+            Dict {exchange: {simbolo: posizione}} con le sole posizioni aperte
+        """
+        positions_by_exchange = {}
+        
+        for exchange_name in exchange_names:
+            exchange = self.exchange_manager.exchanges.get(exchange_name)
+            if not exchange:
+                continue
+            
+            try:
+                positions = exchange.fetch_positions()
+            except Exception as e:
+                logger.error(f"Errore recupero posizioni {exchange_name}: {e}")
+                if ExchangeUtils.is_auth_error(str(e)):
+                    self.exchange_manager.invalidate_exchange(exchange_name)
+                continue
+            
+            positions_by_exchange[exchange_name] = {
+                p.get('symbol'): p for p in positions
+                if p.get('contracts') or p.get('size') or p.get('notional')
+            }
+            logger.info(f"Trovate {len(positions_by_exchange[exchange_name])} posizioni aperte su {exchange_name}")
+        
+        return positions_by_exchange
+    
+    def is_safety_triggered(self, positions: List[Dict], price_by_exchange: Dict[str, float]) -> bool:
+        """Verifica se il prezzo corrente ha superato il safety_value di almeno una posizione
+        
+        Per una long il pericolo è prezzo < safety_value, per una short prezzo > safety_value:
+        entrambi si riducono a (prezzo - safety_value) * segno < 0.
+        
+        Args:
+            positions: Posizioni aperte del bot
+            price_by_exchange: Prezzi correnti per exchange
+            
+        Returns:
+            True se almeno una posizione è in pericolo
+        """
+        for position in positions:
+            safety_value = position.get("safety_value")
+            sign = SIDE_SIGN.get(position.get("side"))
+            current_price = price_by_exchange.get(position.get("exchange"))
+            if safety_value is None or sign is None or current_price is None:
+                continue
+            if (current_price - safety_value) * sign < 0:
+                return True
+        return False
+    
+    def fetch_prices_by_exchange(self, exchange_names) -> Dict[str, float]:
+        """Recupera il prezzo corrente SOLANA una sola volta per exchange
+        
+        Args:
+            exchange_names: Exchange per cui recuperare il prezzo
+            
+        Returns:
+            Dict {exchange: prezzo}; gli exchange senza prezzo disponibile sono omessi
+        """
+        price_by_exchange = {}
+        for exchange_name in exchange_names:
+            price = self.exchange_manager.get_solana_price(exchange_name)
+            if price:
+                price_by_exchange[exchange_name] = price
+        return price_by_exchange
+    
+    def analyze_and_balance_position(self, position: Dict, target_leverage: float, api_keys: Dict,
+                                     positions_by_exchange: Optional[Dict[str, Dict[str, Dict]]] = None,
+                                     price_by_exchange: Optional[Dict[str, float]] = None) -> bool:
         """Analizza una posizione, calcola la leva effettiva e ribilancia se necessario
         
         Args:
             position: Dati della posizione
             target_leverage: Leva target del bot
             api_keys: API keys dell'utente
+            positions_by_exchange: Posizioni già recuperate per exchange e simbolo (opzionale)
+            price_by_exchange: Prezzi correnti già recuperati per exchange (opzionale)
             
         Returns:
             True se il balancing è completato con successo o non necessario, False altrimenti
@@ -290,42 +580,57 @@ class Balancer:
             symbol = position["symbol"]
             side = position["side"]
             
-            logger.info(f"Analisi posizione {position_id} su {exchange_name} ({symbol})")
+            logger.debug("Analisi posizione %s su %s (%s)", position_id, exchange_name, symbol)
             
-            # Recupera la posizione aggiornata dall'exchange
+            # Usa la posizione già recuperata per questo exchange, se disponibile
             exchange_position = None
-            if exchange_name.lower() == "bitfinex":
-                exchange_position = self.get_bitfinex_position(exchange_manager)
+            if positions_by_exchange and exchange_name in positions_by_exchange:
+                exchange_positions = positions_by_exchange[exchange_name]
+                exchange_position = exchange_positions.get(symbol)
+                if exchange_position is None and exchange_positions:
+                    # Simbolo non corrispondente: usa la prima posizione aperta (come i getter)
+                    exchange_position = next(iter(exchange_positions.values()))
+            
+            # Fallback: recupera la posizione aggiornata dall'exchange
+            elif exchange_name.lower() == "bitfinex":
+                exchange_position = self.get_bitfinex_position(self.exchange_manager)
             elif exchange_name.lower() == "bitmex":
-                exchange_position = self.get_bitmex_position(exchange_manager)
+                exchange_position = self.get_bitmex_position(self.exchange_manager)
             
             if not exchange_position:
                 logger.warning(f"Impossibile recuperare posizione da {exchange_name}")
                 return False
             
-            # Calcola la leva effettiva
-            effective_leverage = None
-            if exchange_name.lower() == "bitfinex":
-                # Per Bitfinex, calcola sempre manualmente la leva effettiva
-                # usando il prezzo corrente invece della leva restituita dall'exchange
-                effective_leverage = self.calculate_effective_leverage(exchange_position, exchange_name)
-            else:
-                effective_leverage = self.calculate_effective_leverage(exchange_position, exchange_name)
+            # Estrai una sola volta i campi usati dai calcoli
+            normalized_position = self.normalize_position(exchange_position, exchange_name)
+            if normalized_position is None:
+                logger.warning(f"Impossibile normalizzare posizione {position_id}")
+                return False
+            
+            # Prezzo corrente già recuperato per questo exchange (None = recupero on-demand)
+            current_price = (price_by_exchange or {}).get(exchange_name)
             
-            if effective_leverage is None:
+            # Calcola la leva effettiva (per Bitfinex sempre manualmente con il prezzo corrente)
+            leverage_result = self.calculate_effective_leverage(normalized_position, current_price)
+            
+            if leverage_result is None:
                 logger.warning(f"Impossibile calcolare leva effettiva per posizione {position_id}")
                 return False
             
-            logger.info(f"Leva effettiva: {effective_leverage:.2f}X, Leva target: {target_leverage:.2f}X")
+            # Prezzo e valore nominale vengono riusati per il calcolo del margine
+            effective_leverage, nominal_value, current_price = leverage_result
+            
+            logger.info("Posizione %s: leva effettiva %.2fX, leva target %.2fX", position_id, effective_leverage, target_leverage)
             
             # Verifica se è necessario ribilanciare
             leverage_diff = abs(effective_leverage - target_leverage)
             
             if leverage_diff > 0.1:  # Deviazione superiore a 0.1X
-                logger.info(f"Deviazione leva: {leverage_diff:.2f}X - Ribilanciamento necessario")
+                logger.info("Deviazione leva: %.2fX - Ribilanciamento necessario", leverage_diff)
                 
                 # Calcola quanto margine aggiungere o rimuovere
-                margin_diff = self.calculate_margin_adjustment(exchange_position, target_leverage, exchange_name, api_keys, symbol)
+                margin_diff = self.calculate_margin_adjustment(normalized_position, target_leverage, api_keys, symbol,
+                                                               current_price=current_price, nominal_value=nominal_value)
                 
                 if margin_diff is None:
                     logger.warning(f"Impossibile calcolare aggiustamento margine per posizione {position_id}")
@@ -333,7 +638,8 @@ class Balancer:
                 
                 # Esegui il ribilanciamento
                 if exchange_name.lower() == "bitfinex":
-                    success = self.adjust_bitfinex_margin(exchange_position, margin_diff, api_keys, symbol, target_leverage)
+                    success = self.adjust_bitfinex_margin(exchange_position, margin_diff, api_keys, symbol, target_leverage,
+                                                          self.exchange_manager)
                 elif exchange_name.lower() == "bitmex":
                     success = self.adjust_bitmex_margin(exchange_position, margin_diff, api_keys, symbol)
                 else:
@@ -347,7 +653,7 @@ class Balancer:
                     logger.warning(f"Ribilanciamento fallito per posizione {position_id}")
                     return False
             else:
-                logger.info(f"Leva già entro i parametri desiderati (diff: {leverage_diff:.2f}X)")
+                logger.info("Leva già entro i parametri desiderati (diff: %.2fX)", leverage_diff)
                 return True  # Nessun ribilanciamento necessario = successo
             
         except Exception as e:
@@ -380,7 +686,7 @@ class Balancer:
                 
                 # Controlla se la posizione è aperta
                 if contracts != 0 or size != 0 or notional != 0:
-                    logger.info(f"Posizione trovata: {position.get('symbol')} - Size: {contracts or size} - Notional: {notional}")
+                    logger.info("Posizione trovata: %s - Size: %s - Notional: %s", position.get('symbol'), contracts or size, notional)
                     return position
             
             logger.warning("Nessuna posizione aperta trovata su Bitfinex")
@@ -412,7 +718,7 @@ class Balancer:
             for position in positions:
                 current_qty = position.get('contracts', 0)
                 if current_qty != 0:
-                    logger.info(f"Posizione trovata: {position.get('symbol')} - Size: {current_qty}")
+                    logger.info("Posizione trovata: %s - Size: %s", position.get('symbol'), current_qty)
                     return position
             
             logger.warning("Nessuna posizione aperta trovata su BitMEX")
@@ -422,58 +728,36 @@ class Balancer:
             logger.error(f"Errore recupero posizione BitMEX: {e}")
             return None
     
-    def calculate_effective_leverage(self, position: Dict, exchange_name: str) -> Optional[float]:
-        """Calcola la leva effettiva di una posizione
+    def normalize_position(self, position: Dict, exchange_name: str) -> Optional[NormalizedPosition]:
+        """Estrae una sola volta i campi della posizione exchange usati nei calcoli
+        
+        Gestisce gli alias dei campi margine di Bitfinex e, per BitMEX, il fallback
+        sui dati raw 'info' e la conversione da Satoshi USDT.
         
         Args:
-            position: Dati della posizione
+            position: Posizione restituita da CCXT
             exchange_name: Nome dell'exchange
             
         Returns:
-            Leva effettiva o None se errore
+            NormalizedPosition o None se errore
         """
         try:
-            # Estrai i dati necessari dalla posizione
-            if exchange_name.lower() == "bitfinex":
-                # Per Bitfinex, il notional rappresenta effettivamente la size della posizione
-                # Calcola sempre manualmente la leva effettiva usando il prezzo corrente
-                size = position.get('notional', 0)  # Per Bitfinex, notional = size in SOL
-                margin = position.get('collateral') or position.get('margin') or position.get('initialMargin', 0)
-                
-                # Ottieni il prezzo corrente di Solana
-                current_price = exchange_manager.get_solana_price(exchange_name)
-                if not current_price:
-                    logger.error(f"Impossibile ottenere prezzo corrente per calcolo leva")
-                    return None
-                
-                if size == 0 or margin == 0:
-                    logger.error(f"Dati insufficienti per calcolare leva: size={size}, margin={margin}")
-                    return None
-                
-                # Calcola nominal value con prezzo corrente
-                nominal_value = abs(size * current_price)
-                
-                # Calcola leva effettiva: valore posizione / margine
-                leverage = nominal_value / margin
-                
-                # Debug dettagliato del calcolo
-                logger.info(f"=== DEBUG CALCOLO LEVA BITFINEX ===")
-                logger.info(f"Size posizione (notional): {size} SOL")
-                logger.info(f"Prezzo corrente SOL: {current_price:.4f} USDT")
-                logger.info(f"Margine/Collaterale: {margin:.4f} USDT")
-                logger.info(f"Calcolo: |{size} * {current_price:.4f}| / {margin:.4f} = {nominal_value:.4f} / {margin:.4f} = {leverage:.4f}X")
-                logger.info(f"Leva effettiva finale: {leverage:.2f}X")
-                logger.info(f"=== FINE DEBUG CALCOLO LEVA ===")
+            exchange_name = exchange_name.lower()
+            
+            if exchange_name == "bitfinex":
+                # Per Bitfinex, il notional rappresenta effettivamente la size della posizione in SOL
+                size = position.get('notional') or 0
+                margin = _first_nonzero(position, _MARGIN_KEYS)
                 
-            elif exchange_name.lower() == "bitmex":
-                # Per BitMEX
-                notional = float(position.get('notional', 0))  # Valore della posizione in USDT
-                margin = position.get('initialMargin') or position.get('collateral') or position.get('maintenanceMargin', 0)
+            elif exchange_name == "bitmex":
+                # Per BitMEX, il notional è il valore della posizione in USDT
+                size = float(position.get('notional') or 0)
+                margin = _first_nonzero(position, _BITMEX_MARGIN_KEYS)
                 
                 # Controlla anche il campo 'info' che potrebbe contenere dati raw
                 info = position.get('info', {})
                 if margin == 0 and info:
-                    margin = info.get('posMargin') or info.get('posInit') or info.get('initMargin', 0)
+                    margin = _first_nonzero(info, _BITMEX_INFO_MARGIN_KEYS)
                 
                 # Assicurati che margin sia un numero
                 try:
@@ -483,107 +767,149 @@ class Balancer:
                     return None
                 
                 # Converti da Satoshis a USDT se necessario
-                if margin > 1000000:  # Probabilmente in Satoshis
-                    margin = margin / 1_000_000  # Converti da Satoshis a USDT
+                if margin > USDT_SATOSHI:  # Probabilmente in Satoshis
+                    margin = margin / USDT_SATOSHI
                 
-                if notional == 0 or margin == 0:
-                    logger.error(f"Dati insufficienti per calcolare leva: notional={notional}, margin={margin}")
+            else:
+                logger.error(f"Exchange {exchange_name} non supportato")
+                return None
+            
+            return NormalizedPosition(
+                exchange=exchange_name,
+                symbol=position.get('symbol') or '',
+                side=position.get('side') or '',
+                size=size,
+                margin=margin,
+                entry_price=position.get('entryPrice') or 0,
+                unrealized_pnl=position.get('unrealizedPnl') or 0
+            )
+            
+        except Exception as e:
+            logger.error(f"Errore normalizzazione posizione {exchange_name}: {e}")
+            return None
+    
+    def calculate_effective_leverage(self, position: NormalizedPosition,
+                                     current_price: Optional[float] = None) -> Optional[Tuple[float, float, Optional[float]]]:
+        """Calcola la leva effettiva di una posizione
+        
+        Args:
+            position: Posizione normalizzata
+            current_price: Prezzo corrente già recuperato (opzionale, altrimenti viene richiesto all'exchange)
+            
+        Returns:
+            Tupla (leva effettiva, valore nominale, prezzo corrente usato) o None se errore;
+            valore nominale e prezzo possono essere riusati da calculate_margin_adjustment
+        """
+        try:
+            size = position.size
+            margin = position.margin
+            
+            if position.exchange == "bitfinex":
+                # Per Bitfinex calcola sempre manualmente la leva effettiva usando il prezzo corrente
+                if not current_price:
+                    current_price = self.exchange_manager.get_solana_price(position.exchange)
+                if not current_price:
+                    logger.error(f"Impossibile ottenere prezzo corrente per calcolo leva")
                     return None
                 
-                # Calcola leva: valore posizione / margine
-                leverage = abs(notional / margin)
+                if size == 0 or margin == 0:
+                    logger.error(f"Dati insufficienti per calcolare leva: size={size}, margin={margin}")
+                    return None
+                
+                # Calcola nominal value con prezzo corrente
+                nominal_value = abs(size * current_price)
+                
+                # Calcola leva effettiva: valore posizione / margine
+                leverage = leverage_for_margin(nominal_value, margin)
+                
+                # Debug dettagliato del calcolo (formattato solo se il livello DEBUG è attivo)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("=== DEBUG CALCOLO LEVA BITFINEX ===")
+                    logger.debug("Size posizione (notional): %s SOL", size)
+                    logger.debug("Prezzo corrente SOL: %.4f USDT", current_price)
+                    logger.debug("Margine/Collaterale: %.4f USDT", margin)
+                    logger.debug("Calcolo: |%s * %.4f| / %.4f = %.4f / %.4f = %.4fX",
+                                 size, current_price, margin, nominal_value, margin, leverage)
+                    logger.debug("=== FINE DEBUG CALCOLO LEVA ===")
                 
             else:
-                logger.error(f"Exchange {exchange_name} non supportato per calcolo leva")
-                return None
+                # Per BitMEX il notional è già in USDT
+                if size == 0 or margin == 0:
+                    logger.error(f"Dati insufficienti per calcolare leva: notional={size}, margin={margin}")
+                    return None
+                
+                # Calcola leva: valore posizione / margine
+                nominal_value = abs(size)
+                leverage = abs(leverage_for_margin(size, margin))
             
-            logger.info(f"Leva effettiva calcolata: {leverage:.2f}X")
-            return leverage
+            logger.debug("Leva effettiva calcolata: %.2fX", leverage)
+            return leverage, nominal_value, current_price
             
         except Exception as e:
             logger.error(f"Errore calcolo leva effettiva: {e}")
             return None
     
-    def calculate_margin_adjustment(self, position: Dict, target_leverage: float, exchange_name: str, api_keys: Dict, symbol_from_db: str = None) -> Optional[float]:
+    def calculate_margin_adjustment(self, position: NormalizedPosition, target_leverage: float, api_keys: Dict, symbol_from_db: str = None,
+                                    current_price: Optional[float] = None, nominal_value: Optional[float] = None) -> Optional[float]:
         """Calcola quanto margine aggiungere o rimuovere per raggiungere la leva target
         
         Args:
-            position: Dati della posizione
+            position: Posizione normalizzata
             target_leverage: Leva target
-            exchange_name: Nome dell'exchange
+            api_keys: API keys dell'utente
+            symbol_from_db: Simbolo della posizione nel database (opzionale)
+            current_price: Prezzo corrente già recuperato (opzionale, altrimenti viene richiesto all'exchange)
+            nominal_value: Valore nominale già calcolato da calculate_effective_leverage (opzionale, solo Bitfinex)
             
         Returns:
             Differenza di margine (positiva = aggiungere, negativa = rimuovere) o None se errore
         """
         try:
-            # Estrai i dati necessari dalla posizione
-            if exchange_name.lower() == "bitfinex":
-                # Per Bitfinex, il notional rappresenta effettivamente la size della posizione
-                size = position.get('notional', 0)  # Per Bitfinex, notional = size in SOL
-                entry_price = position.get('entryPrice', 0)  # Prezzo di entrata
-                current_margin = position.get('collateral') or position.get('margin') or position.get('initialMargin', 0)
-                unrealized_pnl = position.get('unrealizedPnl', 0)  # PnL non realizzato
-                symbol = position.get('symbol', '')
-                
-                # Ottieni il prezzo corrente di Solana
-                current_price = exchange_manager.get_solana_price(exchange_name)
+            size = position.size
+            current_margin = position.margin
+            
+            if position.exchange == "bitfinex":
+                # Ottieni il prezzo corrente di Solana se non già disponibile
+                if not current_price:
+                    current_price = self.exchange_manager.get_solana_price(position.exchange)
                 if not current_price:
-                    logger.error(f"Impossibile ottenere prezzo corrente per {symbol}")
+                    logger.error(f"Impossibile ottenere prezzo corrente per {position.symbol}")
                     return None
                 
                 if size == 0 or current_margin == 0:
                     logger.error(f"Dati insufficienti per calcolare aggiustamento: size={size}, margin={current_margin}")
                     return None
                 
-                # Valore nominale della posizione usando prezzo corrente
-                nominal_value = abs(size * current_price)
-                
-                # Calcola margine base per leva target
-                base_margin = nominal_value / target_leverage
+                # Valore nominale della posizione usando prezzo corrente (se non già calcolato)
+                if nominal_value is None:
+                    nominal_value = abs(size * current_price)
                 
-                # Sottrai il PnL non realizzato (se positivo riduce il collaterale necessario)
-                target_margin = base_margin - unrealized_pnl
-                
-                # Il margine non può essere negativo o troppo basso
-                target_margin = max(target_margin, 0.05)  # Minimo 0.05 USDT per evitare errore "collateral: insufficient"
+                # Margine per la leva target meno il PnL non realizzato (se positivo riduce il collaterale necessario),
+                # senza scendere sotto il collaterale minimo accettato da Bitfinex
+                target_margin = max(
+                    margin_for_leverage(nominal_value, target_leverage, position.unrealized_pnl),
+                    BITFINEX_MIN_COLLATERAL
+                )
                 
-                logger.info(f"Size posizione: {size} SOL")
-                logger.info(f"Prezzo corrente: {current_price:.4f} USDT")
-                logger.info(f"Prezzo entrata: {entry_price:.4f} USDT")
-                logger.info(f"PnL non realizzato: {unrealized_pnl:.4f} USDT")
-                logger.info(f"Valore nominale posizione: {nominal_value:.2f} USDT")
-                logger.info(f"Margine base per {target_leverage}X: {base_margin:.2f} USDT")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Size posizione: %s SOL", size)
+                    logger.debug("Prezzo corrente: %.4f USDT", current_price)
+                    logger.debug("Prezzo entrata: %.4f USDT", position.entry_price)
+                    logger.debug("PnL non realizzato: %.4f USDT", position.unrealized_pnl)
+                    logger.debug("Valore nominale posizione: %.2f USDT", nominal_value)
+                    logger.debug("Margine base per %sX: %.2f USDT", target_leverage, margin_for_leverage(nominal_value, target_leverage))
                 
                 # Calcola differenza
                 margin_diff = target_margin - current_margin
                 
-            elif exchange_name.lower() == "bitmex":
-                # Per BitMEX
-                notional = float(position.get('notional', 0))  # Valore della posizione in USDT
-                current_margin = position.get('initialMargin') or position.get('collateral') or position.get('maintenanceMargin', 0)
-                
-                # Controlla anche il campo 'info' che potrebbe contenere dati raw
-                info = position.get('info', {})
-                if current_margin == 0 and info:
-                    current_margin = info.get('posMargin') or info.get('posInit') or info.get('initMargin', 0)
-                
-                # Assicurati che current_margin sia un numero
-                try:
-                    current_margin = float(current_margin)
-                except (TypeError, ValueError):
-                    logger.error(f"Impossibile convertire current_margin a float: {current_margin}")
-                    return None
-                
-                # Converti da Satoshis a USDT se necessario
-                if current_margin > 1000000:  # Probabilmente in Satoshis
-                    current_margin = current_margin / 1_000_000  # Converti da Satoshis a USDT
-                
-                if notional == 0 or current_margin == 0:
-                    logger.error(f"Dati insufficienti per calcolare aggiustamento: notional={notional}, margin={current_margin}")
+            else:
+                # Per BitMEX il notional è già in USDT
+                if size == 0 or current_margin == 0:
+                    logger.error(f"Dati insufficienti per calcolare aggiustamento: notional={size}, margin={current_margin}")
                     return None
                 
                 # Calcola margine target per leva target
-                target_margin = notional / target_leverage
+                target_margin = margin_for_leverage(size, target_leverage)
                 
                 # Calcola differenza
                 margin_diff = target_margin - current_margin
@@ -592,7 +918,7 @@ class Balancer:
                 # Questo previene l'errore "insufficient isolated margin" usando i limiti reali di BitMEX
                 if margin_diff < 0:  # Solo quando si riduce il margine
                     # Usa il simbolo dalla posizione del database, non dalla posizione exchange
-                    symbol_to_use = symbol_from_db or position.get('symbol', '')
+                    symbol_to_use = symbol_from_db or position.symbol
                     max_removable = self.get_bitmex_max_removable_margin(symbol_to_use, api_keys)
                     if max_removable is not None:
                         reduction_amount = abs(margin_diff)
@@ -602,26 +928,21 @@ class Balancer:
                         if reduction_amount > safe_max_removable:
                             # Limita la riduzione al massimo sicuro
                             margin_diff = -safe_max_removable
-                            logger.info(f"Riduzione limitata dal posCross di BitMEX:")
-                            logger.info(f"  - Riduzione richiesta: {reduction_amount:.2f} USDT")
-                            logger.info(f"  - Margine max rimovibile: {max_removable:.2f} USDT")
-                            logger.info(f"  - Riduzione sicura (90%): {safe_max_removable:.2f} USDT")
-                            logger.info(f"  - Riduzione finale: {abs(margin_diff):.2f} USDT")
+                            logger.info(
+                                "Riduzione limitata dal posCross di BitMEX: richiesta %.2f USDT, max rimovibile %.2f USDT, "
+                                "sicura (90%%) %.2f USDT, finale %.2f USDT",
+                                reduction_amount, max_removable, safe_max_removable, abs(margin_diff)
+                            )
                         else:
-                            logger.info(f"Riduzione entro i limiti BitMEX: {reduction_amount:.2f} USDT (max: {max_removable:.2f} USDT)")
+                            logger.info("Riduzione entro i limiti BitMEX: %.2f USDT (max: %.2f USDT)", reduction_amount, max_removable)
                     else:
                         logger.warning("Impossibile ottenere posCross da BitMEX, procedendo senza controllo")
-                
-            else:
-                logger.error(f"Exchange {exchange_name} non supportato per calcolo aggiustamento margine")
-                return None
             
-            logger.info(f"Margine attuale: {current_margin:.2f} USDT")
-            logger.info(f"Margine target: {target_margin:.2f} USDT")
-            logger.info(f"Differenza: {margin_diff:.2f} USDT")
+            logger.info("Margine attuale: %.2f USDT, target: %.2f USDT, differenza: %.2f USDT",
+                        current_margin, target_margin, margin_diff)
             
             # Applica una tolleranza di 1 USDT
-            if abs(margin_diff) < 1.0:
+            if within_tolerance(margin_diff, 0.0, 1.0):
                 logger.info("Differenza inferiore a 1 USDT, nessun aggiustamento necessario")
                 return 0
             
@@ -631,7 +952,8 @@ class Balancer:
             logger.error(f"Errore calcolo aggiustamento margine: {e}")
             return None
     
-    def adjust_bitfinex_margin(self, position: Dict, margin_diff: float, api_keys: Dict, symbol: str, target_leverage: float) -> bool:
+    def adjust_bitfinex_margin(self, position: Dict, margin_diff: float, api_keys: Dict, symbol: str, target_leverage: float,
+                               exchange_manager: Optional[ExchangeManager] = None) -> bool:
         """Aggiusta il margine della posizione su Bitfinex
         
         Args:
@@ -640,6 +962,7 @@ class Balancer:
             api_keys: API keys dell'utente
             symbol: Simbolo della posizione
             target_leverage: Leva target per la verifica
+            exchange_manager: ExchangeManager già inizializzato per Bitfinex (default: quello del thread)
             
         Returns:
             True se successo, False altrimenti
@@ -659,7 +982,7 @@ class Balancer:
                 return False
             
             # Ottieni il margine attuale
-            current_margin = position.get('collateral') or position.get('margin') or position.get('initialMargin', 0)
+            current_margin = _first_nonzero(position, _MARGIN_KEYS)
             
             # Calcola il nuovo collaterale
             new_collateral = current_margin + margin_diff
@@ -676,30 +999,32 @@ class Balancer:
             success = self.set_bitfinex_collateral(api_key, api_secret, api_symbol, new_collateral)
             
             if success:
-                logger.info(f"Collaterale aggiustato con successo: {current_margin:.2f} -> {new_collateral:.2f} USDT")
+                logger.info("Collaterale aggiustato con successo: %.2f -> %.2f USDT", current_margin, new_collateral)
                 
-                # Aspetta un momento per permettere all'exchange di aggiornare
-                time.sleep(2)
+                # Per aggiustamenti piccoli la deriva di leva è trascurabile: nessuna verifica
+                if abs(margin_diff) < BITFINEX_VERIFY_MIN_MARGIN_DIFF:
+                    return True
                 
-                # Recupera la posizione aggiornata per verificare la leva effettiva
-                from trading.exchange_manager import ExchangeManager
-                exchange_manager = ExchangeManager()
-                exchange_manager.initialize_exchange('bitfinex', api_key, api_secret)
-                updated_position = self.get_bitfinex_position(exchange_manager)
+                # Verifica la leva effettiva con polling breve, riusando il client già inizializzato
+                if exchange_manager is None:
+                    exchange_manager = self.exchange_manager
                 
-                if updated_position:
-                    # Usa la leva direttamente dalla posizione aggiornata
-                    current_leverage = updated_position.get('leverage', 0)
-                    if current_leverage > 0:
-                        logger.info(f"Leva effettiva dopo aggiustamento: {current_leverage:.4f}X")
-                        
-                        # Verifica se la leva è vicina al target (tolleranza di 0.5X)
-                        if abs(current_leverage - target_leverage) < 0.5:
-                            logger.info(f"Leva aggiustata con successo (target: {target_leverage:.1f}X, attuale: {current_leverage:.4f}X)")
-                        else:
-                            logger.warning(f"Leva attuale ({current_leverage:.4f}X) non è vicina al target di {target_leverage:.1f}X")
+                current_leverage = 0
+                for delay in BITFINEX_VERIFY_DELAYS:
+                    time.sleep(delay)
+                    updated_position = self.get_bitfinex_position(exchange_manager)
+                    current_leverage = (updated_position.get('leverage') or 0) if updated_position else 0
+                    if current_leverage and within_tolerance(current_leverage, target_leverage, 0.5):
+                        break
+                
+                if current_leverage > 0:
+                    # Verifica se la leva è vicina al target (tolleranza di 0.5X)
+                    if within_tolerance(current_leverage, target_leverage, 0.5):
+                        logger.info("Leva aggiustata con successo (target: %.1fX, attuale: %.4fX)", target_leverage, current_leverage)
                     else:
-                        logger.warning("Impossibile recuperare leva dalla posizione aggiornata")
+                        logger.warning(f"Leva attuale ({current_leverage:.4f}X) non è vicina al target di {target_leverage:.1f}X")
+                else:
+                    logger.warning("Impossibile recuperare leva dalla posizione aggiornata")
                 
                 return True
             else:
@@ -724,57 +1049,54 @@ class Balancer:
         """
         try:
             # Endpoint per impostare il collaterale
-            url = "https://api.bitfinex.com/v2/auth/w/deriv/collateral/set"
+            url = BITFINEX_API_URL + BITFINEX_COLLATERAL_SET_PATH
             
-            # Payload per la richiesta
+            # Payload per la richiesta, serializzato una sola volta (la firma copre questi byte)
             payload = {
                 "symbol": symbol,
                 "collateral": collateral_amount
             }
+            body_bytes = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+            api_secret_bytes = api_secret.encode('utf-8')
             
-            # Genera nonce (timestamp in millisecondi)
-            nonce = str(int(time.time() * 1000))
-            
-            # Crea il body della richiesta
-            body = json.dumps(payload)
-            
-            # Crea la stringa per la firma
-            message = f"/api/v2/auth/w/deriv/collateral/set{nonce}{body}"
-            
-            # Genera la firma HMAC-SHA384
-            signature = hmac.new(
-                api_secret.encode('utf-8'),
-                message.encode('utf-8'),
-                hashlib.sha384
-            ).hexdigest()
-            
-            # Headers per l'autenticazione
-            headers = {
-                "accept": "application/json",
-                "content-type": "application/json",
-                "bfx-nonce": nonce,
-                "bfx-apikey": api_key,
-                "bfx-signature": signature
-            }
-            
-            logger.info(f"Impostazione collaterale {collateral_amount:.2f} per posizione {symbol}")
+            logger.info("Impostazione collaterale %.2f per posizione %s", collateral_amount, symbol)
             
-            # Esegui la richiesta
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
+            # Impostare il collaterale è idempotente: su 429/5xx si ripete con nuovo nonce e firma
+            for attempt in range(BITFINEX_COLLATERAL_ATTEMPTS):
+                nonce, signature = self._sign_bitfinex(api_secret_bytes, BITFINEX_COLLATERAL_SET_PATH, body_bytes)
+                
+                # Headers per l'autenticazione
+                headers = {
+                    "accept": "application/json",
+                    "content-type": "application/json",
+                    "bfx-nonce": nonce,
+                    "bfx-apikey": api_key,
+                    "bfx-signature": signature
+                }
+                
+                # Esegui la richiesta inviando esattamente il body firmato
+                response = self._http.post(url, data=body_bytes, headers=headers, timeout=HTTP_TIMEOUT)
+                if response.status_code != 429 and response.status_code < 500:
+                    break
+                logger.warning(f"Errore HTTP {response.status_code} impostazione collaterale (tentativo {attempt + 1})")
+                if attempt + 1 < BITFINEX_COLLATERAL_ATTEMPTS:
+                    time.sleep(0.5 * (attempt + 1))
             
             if response.status_code == 200:
-                result = response.json()
-                logger.info(f"Risposta API: {result}")
+                # Decodifica direttamente i byte della risposta (niente rilevamento dell'encoding)
+                result = json.loads(response.content)
                 
                 # Verifica se l'operazione è riuscita
                 # La risposta [[1]] indica successo secondo la documentazione Bitfinex
-                if isinstance(result, list) and len(result) > 0:
-                    if isinstance(result[0], list) and len(result[0]) > 0 and result[0][0] == 1:
-                        logger.info("Collaterale impostato con successo")
-                        return True
-                    elif result[0] == 1:
-                        logger.info("Collaterale impostato con successo")
-                        return True
+                try:
+                    status = result[0][0]
+                except (IndexError, KeyError, TypeError):
+                    status = None
+                
+                if status == 1:
+                    logger.debug("Stato risposta collaterale: %s", status)
+                    logger.info("Collaterale impostato con successo")
+                    return True
                 
                 logger.error(f"Operazione fallita: {result}")
                 return False
@@ -795,18 +1117,9 @@ class Balancer:
         Returns:
             Simbolo nel formato API Bitfinex (es. "tSOLF0:USTF0")
         """
-        # Mappa dei simboli comuni per derivati
-        symbol_map = {
-            "SOL/USDT:USDT": "tSOLF0:USTF0",
-            "SOL/USDT": "tSOLF0:USTF0",
-            "BTC/USDT:USDT": "tBTCF0:USTF0",
-            "BTC/USDT": "tBTCF0:USTF0",
-            "ETH/USDT:USDT": "tETHF0:USTF0",
-            "ETH/USDT": "tETHF0:USTF0"
-        }
-        
-        converted = symbol_map.get(symbol, symbol)
-        logger.info(f"Conversione simbolo: {symbol} -> {converted}")
+        converted = _BFX_SYMBOL_MAP.get(symbol, symbol)
+        if converted is symbol and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Simbolo %s non mappato, usato così com'è", symbol)
         return converted
     
     def adjust_bitmex_margin(self, position: Dict, margin_diff: float, api_keys: Dict, symbol: str) -> bool:
@@ -837,16 +1150,14 @@ class Balancer:
             
             # Per BitMEX, il margine deve essere espresso in Satoshi della valuta di settlement
             # Per USDT: 1 USDT = 1,000,000 Satoshi USDT
-            amount_satoshis = int(margin_diff * 1_000_000)
+            amount_satoshis = satoshi_amount(margin_diff)
             
             # Converti il simbolo al formato BitMEX
-            bitmex_symbol = symbol.replace('/USDT:USDT', 'USDT').replace('/', '')
-            logger.info(f"Simbolo convertito: {symbol} -> {bitmex_symbol}")
-            
-            logger.info(f"Trasferimento margine: {margin_diff:.2f} USDT = {amount_satoshis} Satoshi USDT")
+            bitmex_symbol = _to_bitmex(symbol)
+            logger.info("Trasferimento margine %s: %.2f USDT = %d Satoshi USDT", bitmex_symbol, margin_diff, amount_satoshis)
             
             # Chiama l'API BitMEX per trasferire margine
-            exchange = exchange_manager.exchanges.get('bitmex')
+            exchange = self.exchange_manager.exchanges.get('bitmex')
             if not exchange:
                 logger.error("Exchange BitMEX non inizializzato")
                 return False
@@ -871,43 +1182,50 @@ class Balancer:
         """Ottiene il margine massimo rimovibile da BitMEX tramite API /position"""
         try:
             # Usa l'exchange già inizializzato tramite CCXT
-            exchange = exchange_manager.exchanges.get('bitmex')
+            exchange = self.exchange_manager.exchanges.get('bitmex')
             if not exchange:
                 logger.error("Exchange BitMEX non inizializzato")
                 return None
             
             # Il simbolo su BitMEX è già nel formato corretto
             bitmex_symbol = symbol  # Usa il simbolo così com'è
-            logger.info(f"Simbolo per posCross: {symbol}")
             
-            # Ottieni tutte le posizioni tramite CCXT
-            positions = exchange.fetch_positions()
-            logger.info(f"Trovate {len(positions)} posizioni totali su BitMEX")
+            # Riusa il valore se recuperato da meno di MAX_REMOVABLE_TTL secondi per lo stesso account
+            cache_key = (ExchangeManager._client_key('bitmex', api_keys.get('bitmex_api_key', ''),
+                                                     api_keys.get('bitmex_api_secret', '')), bitmex_symbol)
+            cached = self._max_removable_cache.get(cache_key)
+            if cached is not None and time.monotonic() - cached[0] < MAX_REMOVABLE_TTL:
+                return cached[1]
             
-            # Cerca la posizione specifica
-            for position in positions:
-                if position.get('symbol') == bitmex_symbol:
-                    # Cerca il campo posCross nei dati raw
-                    info = position.get('info', {})
-                    pos_cross_raw = info.get('posCross', 0)
-                    
-                    # Converti pos_cross in numero se è una stringa
-                    try:
-                        pos_cross = int(pos_cross_raw) if pos_cross_raw else 0
-                    except (ValueError, TypeError):
-                        pos_cross = 0
-                    
-                    logger.info(f"posCross BitMEX per {bitmex_symbol}: {pos_cross} Satoshi = {pos_cross / 1_000_000:.6f} USDT")
-                    
-                    # Controlla se la posizione è attiva (contracts diverso da 0)
-                    if position.get('contracts', 0) != 0 and pos_cross > 0:
-                        # Converte da Satoshi USDT a USDT (dividi per 1.000.000)
-                        max_removable = pos_cross / 1_000_000
-                        logger.info(f"posCross BitMEX per {bitmex_symbol}: {pos_cross} Satoshi = {max_removable:.6f} USDT")
-                        return max_removable
-            
-            logger.warning(f"Nessuna posizione attiva trovata per {bitmex_symbol} su BitMEX")
-            return None
+            # Recupera solo la posizione del simbolo (filtro passato all'exchange e verificato qui)
+            positions = exchange.fetch_positions([bitmex_symbol])
+            position = next((pos for pos in positions or () if pos.get('symbol') == bitmex_symbol), None)
+            
+            max_removable = None
+            if position:
+                # Cerca il campo posCross nei dati raw e converte da Satoshi USDT a USDT
+                info = position.get('info', {})
+                pos_cross = _satoshi_to_int(info.get('posCross', 0))
+                pos_cross_usdt = pos_cross / USDT_SATOSHI
+                contracts = position.get('contracts', 0)
+                
+                logger.info("posCross BitMEX %s: %d Satoshi = %.6f USDT (contracts=%s)",
+                            bitmex_symbol, pos_cross, pos_cross_usdt, contracts)
+                
+                # Controlla se la posizione è attiva (contracts diverso da 0)
+                if contracts != 0 and pos_cross > 0:
+                    max_removable = pos_cross_usdt
+            
+            if max_removable is None:
+                logger.warning(f"Nessuna posizione attiva trovata per {bitmex_symbol} su BitMEX")
+            
+            now = time.monotonic()
+            with self._max_removable_lock:
+                # Rimuove i valori scaduti prima di salvare il nuovo
+                for key in [k for k, (ts, _) in self._max_removable_cache.items() if now - ts >= MAX_REMOVABLE_TTL]:
+                    del self._max_removable_cache[key]
+                self._max_removable_cache[cache_key] = (now, max_removable)
+            return max_removable
                 
         except Exception as e:
             logger.error(f"Errore chiamata API BitMEX /position: {e}")
@@ -937,7 +1255,7 @@ class Balancer:
                 logger.warning(f"API keys Bitfinex mancanti per utente {user_id}")
                 return True  # Non bloccare se non ci sono API keys
             
-            success = exchange_manager.initialize_exchange("bitfinex", api_key, api_secret)
+            success = self.exchange_manager.initialize_exchange("bitfinex", api_key, api_secret)
             if not success:
                 logger.error(f"Impossibile inizializzare exchange Bitfinex per utente {user_id}")
                 return False
@@ -948,38 +1266,41 @@ class Balancer:
                 logger.warning("Impossibile recuperare saldi wallet Bitfinex")
                 return False
             
-            logger.info(f"Saldi wallet Bitfinex: {wallet_balances}")
+            logger.info("Saldi wallet Bitfinex: %s", wallet_balances)
             
-            # Identifica fondi disponibili per il consolidamento
-            consolidation_transfers = []
+            # Identifica fondi disponibili per il consolidamento, aggregando gli importi
+            # per (from_wallet, to_wallet, currency_from, currency_to): un solo
+            # trasferimento per ogni combinazione
+            grouped_amounts = defaultdict(float)
             
             # Controlla wallet exchange (UST)
             exchange_ust = wallet_balances.get('exchange', {}).get('UST', 0)
             if exchange_ust > 0:
-                consolidation_transfers.append({
-                    'amount': exchange_ust,
-                    'from_wallet': 'exchange',
-                    'to_wallet': 'margin',
-                    'currency_from': 'UST',
-                    'currency_to': 'USTF0'
-                })
+                grouped_amounts[('exchange', 'margin', 'UST', 'USTF0')] += exchange_ust
             
             # Controlla wallet margin (UST) - se presente
             margin_ust = wallet_balances.get('margin', {}).get('UST', 0)
             if margin_ust > 0:
-                consolidation_transfers.append({
-                    'amount': margin_ust,
-                    'from_wallet': 'margin',
-                    'to_wallet': 'margin',
-                    'currency_from': 'UST',
-                    'currency_to': 'USTF0'
-                })
+                grouped_amounts[('margin', 'margin', 'UST', 'USTF0')] += margin_ust
+            
+            consolidation_transfers = [
+                {
+                    'amount': amount,
+                    'from_wallet': from_wallet,
+                    'to_wallet': to_wallet,
+                    'currency_from': currency_from,
+                    'currency_to': currency_to
+                }
+                for (from_wallet, to_wallet, currency_from, currency_to), amount in grouped_amounts.items()
+            ]
             
             # Esegui i trasferimenti
             if not consolidation_transfers:
                 logger.info("Nessun trasferimento necessario - fondi già consolidati")
                 return True
             
+            # I trasferimenti restano sequenziali: condividono il client firmato e Bitfinex
+            # rifiuta le richieste con nonce non crescente
             success_count = 0
             for transfer in consolidation_transfers:
                 try:
@@ -1023,7 +1344,7 @@ class Balancer:
             Dict: Saldi organizzati per wallet e valuta
         """
         try:
-            exchange = exchange_manager.exchanges.get('bitfinex')
+            exchange = self.exchange_manager.exchanges.get('bitfinex')
             if not exchange:
                 logger.error("Exchange Bitfinex non inizializzato")
                 return {}
@@ -1044,11 +1365,11 @@ class Balancer:
                 if isinstance(balance_data, list):
                     for balance_entry in balance_data:
                         if isinstance(balance_entry, list) and len(balance_entry) >= 5:
-                            wallet_type = balance_entry[0]  # exchange, margin, funding
-                            currency = balance_entry[1]     # UST, USTF0, etc.
-                            available = float(balance_entry[4]) if balance_entry[4] else 0
+                            # [wallet_type (exchange, margin, funding), currency (UST, USTF0, ...), _, _, available, ...]
+                            wallet_type, currency, _, _, available, *_ = balance_entry
+                            available = float(available) if available else 0.0
                             
-                            if wallet_type in wallet_balances and available > 0:
+                            if available > 0 and wallet_type in _WALLET_TYPES:
                                 wallet_balances[wallet_type][currency] = available
             
             return wallet_balances
@@ -1072,7 +1393,7 @@ class Balancer:
             bool: True se il trasferimento è riuscito
         """
         try:
-            exchange = exchange_manager.exchanges.get('bitfinex')
+            exchange = self.exchange_manager.exchanges.get('bitfinex')
             if not exchange:
                 logger.error("Exchange Bitfinex non inizializzato")
                 return False
@@ -1121,17 +1442,22 @@ class Balancer:
             logger.error(f"Errore esecuzione trasferimento Bitfinex: {e}")
             return False
 
-    def update_bot_status_to_running(self, user_id: str, bot_id: str, processed_positions: int):
+    def update_bot_status_to_running(self, user_id: str, bot_id: str, processed_positions: int,
+                                     current_status: Optional[str] = None):
         """Aggiorna lo stato del bot da TRANSFERING a RUNNING dopo un balancing riuscito
         
         Args:
             user_id: ID dell'utente proprietario del bot
             bot_id: ID del bot da aggiornare
             processed_positions: Numero di posizioni processate con successo
+            current_status: Stato del bot letto in questo ciclo (se già RUNNING non scrive sul database)
         """
         try:
+            if current_status == self.STATUS_RUNNING:
+                return
+            
             # Aggiorna lo stato del bot nel database
-            update_result = bot_manager.update_bot_status(user_id, BOT_STATUS["RUNNING"])
+            update_result = bot_manager.update_bot_status(user_id, self.STATUS_RUNNING)
             
             if update_result:
                 logger.info(f"✅ Bot {bot_id} aggiornato da TRANSFERING a RUNNING - {processed_positions} posizioni bilanciate con successo")
@@ -6,45 +6,83 @@ Questo script monitora i bot con stato "stop_requested" e chiude le posizioni ap
 Funziona in modo simile all'opener.py ma per la chiusura delle posizioni.
 
 Uso:
-    python -m trading.closer
+    python -m trading.closer          # un solo ciclo
+    python -m trading.closer --loop   # processo continuo: un ciclo a ogni richiesta di stop (change stream
+                                      # MongoDB), con polling di sicurezza ogni CLOSER_FALLBACK_POLL_INTERVAL
+                                      # secondi o, senza change stream, ogni CLOSER_POLL_INTERVAL secondi
 """
 
+import atexit
 import logging
+import queue
 import sys
 import os
 import time
-from typing import Dict, List, Optional
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional, Tuple
+from collections import defaultdict
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Crea directory logs se non esiste
 os.makedirs("logs", exist_ok=True)
 
-# Configura logging
+# Configura logging: i worker accodano i record già formattati, la scrittura su
+# stdout e file avviene in un thread dedicato (nessuna I/O bloccante nei worker)
+_log_queue = queue.Queue(-1)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler(f"logs/closer_{datetime.now().strftime('%Y%m%d')}.log")
-    ]
+    handlers=[QueueHandler(_log_queue)]
 )
+_log_listener = QueueListener(
+    _log_queue,
+    logging.StreamHandler(sys.stdout),
+    logging.FileHandler(f"logs/closer_{datetime.now().strftime('%Y%m%d')}.log")
+)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 logger = logging.getLogger(__name__)
 
 # Importa moduli necessari
 from database.models import bot_manager, position_manager, user_manager
-from trading.exchange_manager import exchange_manager
-from config.settings import BOT_STATUS
+from trading.exchange_manager import ExchangeManager
+from config.settings import BOT_STATUS, CLOSER_POLL_INTERVAL, CLOSER_FALLBACK_POLL_INTERVAL
+
+# Numero massimo di bot chiusi in parallelo (operazioni dominate dalla latenza di rete)
+MAX_WORKERS = 8
+
+# Campi delle posizioni usati per la chiusura
+POSITION_FIELDS = ("position_id", "exchange", "symbol", "side", "size", "status")
 
 class Closer:
     """
     Classe che gestisce la chiusura delle posizioni per i bot con stato "stop_requested"
     """
     
+    # Stato finale del bot per tipo di stop (default: STOPPED)
+    _STOP_STATUS = {
+        "safety": BOT_STATUS["TRANSFER_REQUESTED"],
+        "manual": BOT_STATUS["STOPPED"],
+    }
+    
     def __init__(self):
         """Inizializza il closer"""
+        # ExchangeManager per thread: ogni worker usa le API keys del proprio bot
+        self._local = threading.local()
         logger.info("Closer inizializzato")
     
+    @property
+    def exchange_manager(self) -> ExchangeManager:
+        """ExchangeManager del thread corrente (creato alla prima richiesta)"""
+        manager = getattr(self._local, "exchange_manager", None)
+        if manager is None:
+            manager = ExchangeManager()
+            self._local.exchange_manager = manager
+        return manager
+    
     def run(self):
         """
         Esegue il closer per cercare bot con stato "stop_requested"
@@ -58,9 +96,32 @@ class Closer:
             if stop_requested_bots:
                 logger.info(f"Trovati {len(stop_requested_bots)} bot con richiesta di stop")
                 
-                # Processa ogni bot
-                for bot in stop_requested_bots:
-                    self.process_bot(bot)
+                # Recupera in blocco posizioni aperte e API keys di tutti i bot
+                positions_by_bot = position_manager.get_open_positions_for_bots([b["_id"] for b in stop_requested_bots],
+                                                                                projection=POSITION_FIELDS)
+                
+                # Bot senza posizioni aperte: stato finale subito, senza API keys né exchange
+                bots_to_close = stop_requested_bots
+                if positions_by_bot is not None:
+                    bots_to_close = []
+                    for bot in stop_requested_bots:
+                        if positions_by_bot.get(bot["_id"]):
+                            bots_to_close.append(bot)
+                        else:
+                            logger.info(f"Nessuna posizione aperta trovata per bot {bot['_id']}")
+                            self._finalize(bot["user_id"], bot.get("stopped_type", "manual"), "no_positions")
+                
+                if bots_to_close:
+                    api_keys_by_user = user_manager.get_users_api_keys([b["user_id"] for b in bots_to_close])
+                    
+                    def process(bot):
+                        # Se il recupero in blocco è fallito process_bot ricarica i dati del singolo bot
+                        positions = positions_by_bot.get(bot["_id"]) if positions_by_bot is not None else None
+                        self.process_bot(bot, positions, api_keys_by_user.get(str(bot["user_id"])))
+                    
+                    # Processa i bot in parallelo
+                    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(bots_to_close))) as executor:
+                        list(executor.map(process, bots_to_close))
                 
                 logger.info(f"Elaborazione completata: {len(stop_requested_bots)} bot processati")
             else:
@@ -69,12 +130,38 @@ class Closer:
         except Exception as e:
             logger.error(f"Errore nel ciclo: {e}")
     
-    def process_bot(self, bot: Dict):
+    def watch_stop_requests(self, wake: threading.Event):
+        """
+        Segue il change stream dei bot e segnala ogni passaggio a "stop_requested"
+        
+        Blocca finché lo stream è attivo: va eseguito in un thread dedicato.
+        
+        Args:
+            wake: Evento impostato a ogni nuova richiesta di stop
+        """
+        stop_requested = BOT_STATUS["STOP_REQUESTED"]
+        pipeline = [{"$match": {"$or": [
+            {"operationType": "update", "updateDescription.updatedFields.status": stop_requested},
+            {"operationType": {"$in": ["insert", "replace"]}, "fullDocument.status": stop_requested}
+        ]}}]
+        
+        try:
+            with bot_manager.bots.watch(pipeline) as stream:
+                logger.info("Change stream bot attivo")
+                for change in stream:
+                    logger.info(f"Richiesta di stop ricevuta per bot {change.get('documentKey', {}).get('_id')}")
+                    wake.set()
+        except Exception as e:
+            logger.warning(f"Change stream bot non disponibile, uso del polling: {e}")
+    
+    def process_bot(self, bot: Dict, open_positions: Optional[List[Dict]] = None, api_keys: Optional[Dict] = None):
         """
         Processa un bot con stato "stop_requested"
         
         Args:
             bot: Dati del bot da processare
+            open_positions: Posizioni aperte già recuperate (se None vengono lette dal database)
+            api_keys: API keys dell'utente già recuperate (se None vengono lette dal database)
         """
         try:
             user_id = bot["user_id"]
@@ -83,33 +170,29 @@ class Closer:
             logger.info(f"Processando bot {bot_id} dell'utente {user_id}")
             
             # Recupera posizioni aperte per questo bot
-            open_positions = position_manager.get_bot_positions(bot_id)
-            open_positions = [p for p in open_positions if p["status"] == "open"]
+            if open_positions is None:
+                open_positions = position_manager.get_bot_open_positions(bot_id, projection=POSITION_FIELDS)
             
             if not open_positions:
                 logger.info(f"Nessuna posizione aperta trovata per bot {bot_id}")
                 # Mantieni la distinzione anche quando non ci sono posizioni
-                stopped_type = bot.get("stopped_type", "manual")
-                if stopped_type == "safety":
-                    bot_manager.update_bot_status(user_id, BOT_STATUS["TRANSFER_REQUESTED"], "no_positions", transfer_reason="emergency_close")
-                else:
-                    bot_manager.update_bot_status(user_id, BOT_STATUS["STOPPED"], "no_positions")
+                self._finalize(user_id, bot.get("stopped_type", "manual"), "no_positions")
                 return
             
             logger.info(f"Trovate {len(open_positions)} posizioni da chiudere per bot {bot_id}")
             
             # Recupera API keys dell'utente
-            api_keys = user_manager.get_user_api_keys(user_id)
+            if api_keys is None:
+                api_keys = user_manager.get_user_api_keys(user_id)
             if not api_keys:
                 logger.error(f"API keys non trovate per utente {user_id}")
                 # Mantieni la distinzione anche per API keys mancanti
-                stopped_type = bot.get("stopped_type", "manual")
-                if stopped_type == "safety":
-                    bot_manager.update_bot_status(user_id, BOT_STATUS["TRANSFER_REQUESTED"], "api_keys_missing", transfer_reason="emergency_close")
-                else:
-                    bot_manager.update_bot_status(user_id, BOT_STATUS["STOPPED"], "api_keys_missing")
+                self._finalize(user_id, bot.get("stopped_type", "manual"), "api_keys_missing")
                 return
             
+            # ExchangeManager nuovo per il bot: nessun client di bot precedenti sullo stesso thread
+            self._local.exchange_manager = ExchangeManager()
+            
             # Inizializza gli exchange necessari
             exchanges_to_init = set(pos["exchange"] for pos in open_positions)
             for exchange_name in exchanges_to_init:
@@ -120,7 +203,7 @@ class Closer:
                     logger.error(f"API keys mancanti per {exchange_name}")
                     continue
                 
-                success = exchange_manager.initialize_exchange(
+                success = self.exchange_manager.initialize_exchange(
                     exchange_name,
                     api_key,
                     api_secret
@@ -130,25 +213,37 @@ class Closer:
                     logger.error(f"Impossibile inizializzare {exchange_name}")
                     continue
                 
-                logger.info(f"Exchange {exchange_name} inizializzato con successo")
+                logger.debug("Exchange %s inizializzato con successo", exchange_name)
             
-            # Chiudi le posizioni
+            # Chiudi le posizioni: exchange diversi in parallelo, stesso exchange in sequenza
             errors = []
             closed_count = 0
             
+            positions_by_exchange = defaultdict(list)
             for position in open_positions:
-                try:
-                    # Passa la posizione completa a close_position
-                    result = self.close_position(position)
-                    if result["success"]:
-                        closed_count += 1
-                        logger.info(f"Posizione {position['position_id']} chiusa con successo")
-                    else:
-                        errors.append(f"{position['exchange']} {position['side']}: {result['error']}")
-                        logger.error(f"Errore chiusura posizione {position['position_id']}: {result['error']}")
-                except Exception as e:
-                    errors.append(f"{position['exchange']} {position['side']}: {str(e)}")
-                    logger.error(f"Errore chiusura posizione: {e}")
+                positions_by_exchange[position["exchange"]].append(position)
+            
+            manager = self.exchange_manager
+            with ThreadPoolExecutor(max_workers=len(positions_by_exchange)) as executor:
+                futures = [
+                    executor.submit(self.close_exchange_positions, manager, exchange_positions)
+                    for exchange_positions in positions_by_exchange.values()
+                ]
+                results = [item for future in futures for item in future.result()]
+            
+            pending_updates = []
+            for position, result in results:
+                if result.get("update") is not None:
+                    pending_updates.append(result["update"])
+                if result["success"]:
+                    closed_count += 1
+                    logger.info(f"Posizione {position['position_id']} chiusa con successo")
+                else:
+                    errors.append(f"{position['exchange']} {position['side']}: {result['error']}")
+                    logger.error(f"Errore chiusura posizione {position['position_id']}: {result['error']}")
+            
+            # Aggiorna lo stato delle posizioni chiuse con una sola scrittura
+            position_manager.bulk_update_positions(pending_updates)
             
             # Aggiorna stato del bot in base al tipo di stop
             stopped_type = bot.get("stopped_type", "manual")
@@ -163,23 +258,59 @@ class Closer:
                 logger.info(f"Tutte le {closed_count} posizioni chiuse con successo")
                 
                 # Distingui tra stop manuale e safety trigger
-                if stopped_type == "safety":
-                    # Safety trigger: imposta stato per transfer requested
-                    logger.info(f"Safety trigger attivato - impostazione stato TRANSFER_REQUESTED")
-                    bot_manager.update_bot_status(user_id, BOT_STATUS["TRANSFER_REQUESTED"], "emergency_close", transfer_reason="emergency_close")
-                else:
-                    # Stop manuale o altri motivi: imposta stato STOPPED
-                    logger.info(f"Stop {stopped_type} - impostazione stato STOPPED")
-                    bot_manager.update_bot_status(user_id, BOT_STATUS["STOPPED"], "success")
+                logger.info(f"Stop {stopped_type} - impostazione stato {self._STOP_STATUS.get(stopped_type, BOT_STATUS['STOPPED'])}")
+                self._finalize(user_id, stopped_type, "success", safety_reason="emergency_close")
             
         except Exception as e:
             logger.error(f"Errore nel processare bot {bot.get('_id')}: {e}")
             # Mantieni la distinzione anche in caso di errore
-            stopped_type = bot.get("stopped_type", "manual")
-            if stopped_type == "safety":
-                bot_manager.update_bot_status(user_id, BOT_STATUS["TRANSFER_REQUESTED"], "emergency_close", transfer_reason="emergency_close")
-            else:
-                bot_manager.update_bot_status(user_id, BOT_STATUS["STOPPED"], "error")
+            self._finalize(bot.get("user_id"), bot.get("stopped_type", "manual"), "error", safety_reason="emergency_close")
+    
+    def _finalize(self, user_id: str, stopped_type: str, reason: str, safety_reason: Optional[str] = None):
+        """
+        Aggiorna lo stato finale del bot in base al tipo di stop
+        
+        Safety trigger: TRANSFER_REQUESTED con transfer_reason "emergency_close";
+        stop manuale o altri motivi: STOPPED.
+        
+        Args:
+            user_id: ID dell'utente proprietario del bot
+            stopped_type: Tipo di stop del bot ("safety", "manual", ...)
+            reason: Motivo registrato nel campo stopped_type
+            safety_reason: Motivo alternativo per il safety trigger (default: reason)
+        """
+        status = self._STOP_STATUS.get(stopped_type, BOT_STATUS["STOPPED"])
+        if status == BOT_STATUS["TRANSFER_REQUESTED"]:
+            bot_manager.update_bot_status(user_id, status, safety_reason or reason, transfer_reason="emergency_close")
+        else:
+            bot_manager.update_bot_status(user_id, status, reason)
+    
+    def close_exchange_positions(self, manager: ExchangeManager, positions: List[Dict]) -> List[Tuple[Dict, Dict]]:
+        """
+        Chiude in sequenza le posizioni di un singolo exchange
+        
+        Eseguito in un worker: usa l'ExchangeManager del thread che processa il bot.
+        
+        Args:
+            manager: ExchangeManager già inizializzato del bot
+            positions: Posizioni del database sullo stesso exchange
+            
+        Returns:
+            list: Coppie (posizione, risultato della chiusura)
+        """
+        self._local.exchange_manager = manager
+        
+        results = []
+        for position in positions:
+            try:
+                # Passa la posizione completa a close_position
+                result = self.close_position(position)
+            except Exception as e:
+                logger.error(f"Errore chiusura posizione: {e}")
+                result = {"success": False, "error": str(e)}
+            results.append((position, result))
+        
+        return results
     
     def close_position(self, position: Dict) -> Dict:
         """
@@ -189,7 +320,8 @@ class Closer:
             position: Dati della posizione da chiudere
             
         Returns:
-            dict: Risultato della chiusura
+            dict: Risultato della chiusura; in caso di successo "update" contiene
+                l'aggiornamento della posizione da scrivere nel database
         """
         try:
             exchange_name = position["exchange"]
@@ -197,26 +329,26 @@ class Closer:
             side = position["side"]
             position_id = position["position_id"]
             
-            logger.info(f"Chiusura posizione {side} su {exchange_name}: {symbol}")
+            logger.debug("Chiusura posizione %s su %s: %s", side, exchange_name, symbol)
             
             # Verifica che l'exchange sia inizializzato
-            if exchange_name not in exchange_manager.exchanges:
+            if exchange_name not in self.exchange_manager.exchanges:
                 logger.error(f"Exchange {exchange_name} non inizializzato")
                 return {"success": False, "error": f"Exchange {exchange_name} non inizializzato"}
             
             # Chiudi la posizione passando l'intero oggetto position
-            result = exchange_manager.close_position(exchange_name)
+            result = self.exchange_manager.close_position(exchange_name, position)
             
             if isinstance(result, dict) and result.get("success"):
                 if result["message"] == "no_position":
                     # Posizione non trovata sull'exchange (già chiusa?)
                     logger.warning(f"Posizione {position_id} non trovata su {exchange_name}, aggiorno DB")
                     # Importante: aggiorna sempre lo stato nel DB anche se non trovata sull'exchange
-                    position_manager.update_position_status(position_id, "closed", {
+                    update = position_manager.position_status_update(position_id, "closed", {
                         "close_price": None,
                         "realized_pnl": None
                     })
-                    return {"success": True}
+                    return {"success": True, "update": update}
                 elif result["message"] == "position_closed":
                     # Posizione chiusa con successo
                     order = result.get("order", {})
@@ -244,12 +376,12 @@ class Closer:
                         }
                     
                     # Aggiorna sempre lo stato nel DB
-                    position_manager.update_position_status(position_id, "closed", close_data)
-                    return {"success": True}
+                    update = position_manager.position_status_update(position_id, "closed", close_data)
+                    return {"success": True, "update": update}
                 else:
                     # Aggiorna comunque lo stato nel DB per sicurezza
-                    position_manager.update_position_status(position_id, "closed", {})
-                    return {"success": True}  # Caso generico di successo
+                    update = position_manager.position_status_update(position_id, "closed", {})
+                    return {"success": True, "update": update}  # Caso generico di successo
             else:
                 error_msg = result.get("error") if isinstance(result, dict) else "Errore sconosciuto"
                 return {"success": False, "error": error_msg}
@@ -259,13 +391,36 @@ class Closer:
             return {"success": False, "error": str(e)}
 
 
-def main():
-    """Funzione principale"""
+def main(loop: bool = False, poll_interval: float = CLOSER_POLL_INTERVAL):
+    """
+    Funzione principale
+    
+    Args:
+        loop: Se True esegue cicli continui riusando client exchange e connessioni
+        poll_interval: Attesa in secondi tra un ciclo e il successivo
+    """
     logger.info("Avvio closer")
     closer = Closer()
-    closer.run()
-    logger.info("Closer terminato")
+    
+    if not loop:
+        closer.run()
+        logger.info("Closer terminato")
+        return
+    
+    # Il change stream sveglia il ciclo a ogni richiesta di stop
+    wake = threading.Event()
+    watcher = threading.Thread(target=closer.watch_stop_requests, args=(wake,), daemon=True)
+    watcher.start()
+    
+    try:
+        while True:
+            wake.clear()
+            closer.run()
+            # Polling completo solo come rete di sicurezza finché il change stream è attivo
+            wake.wait(CLOSER_FALLBACK_POLL_INTERVAL if watcher.is_alive() else poll_interval)
+    except KeyboardInterrupt:
+        logger.info("Closer terminato")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main(loop="--loop" in sys.argv[1:])
\ No newline at end of file
@@ -2,42 +2,211 @@
 Gestore degli exchange con CCXT
 """
 import ccxt
+import functools
+import hashlib
 import logging
+import threading
 import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import Dict, Optional, Tuple
 from config.settings import EXCHANGE_SYMBOLS, EXCHANGE_MULTIPLIERS, SOLANA_PRECISION
 from utils.exchange_utils import ExchangeUtils, get_exchange_config
 
 logger = logging.getLogger(__name__)
 
+# Cache dei client CCXT inizializzati: validità (secondi) e numero massimo di client
+CLIENT_CACHE_TTL = 900
+CLIENT_CACHE_MAXSIZE = 256
+
+# Validità (secondi) dell'ultimo prezzo SOLANA letto per exchange: dato pubblico,
+# condiviso tra i bot processati nello stesso ciclo
+PRICE_CACHE_TTL = 1.0
+
+
+def _implements(exchange, method_name: str) -> bool:
+    """True se la classe CCXT dell'exchange implementa davvero il metodo
+    
+    exchange.has non è affidabile: può dichiarare una capacità (es. closePosition
+    su bitmex) senza override del metodo base, che solleva NotSupported.
+    """
+    return method_name in type(exchange).__dict__
+
+
+def _new_session() -> requests.Session:
+    """Sessione HTTP keep-alive di un client CCXT
+    
+    Ogni client ha la propria sessione: CCXT la chiude quando il client viene
+    distrutto (Exchange.__del__), quindi non può essere condivisa. Il riuso delle
+    connessioni tra bot avviene tramite la cache dei client.
+    """
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=3, backoff_factor=0.2)
+    ))
+    return session
+
+
+class ExchangeStrategy:
+    """Comportamento specifico di un exchange (default: size in SOL, nessuna gestione leva)"""
+    
+    name = "default"
+    
+    def size(self, sol_amount: float) -> float:
+        """Converte una quantità in SOL nella size dell'ordine"""
+        return sol_amount
+    
+    def apply_leverage(self, exchange, symbol: str, leverage: float, params: Dict) -> None:
+        """Applica la leva prima dell'ordine (sull'exchange o nei parametri dell'ordine)"""
+    
+    def close(self, manager: "ExchangeManager", exchange, exchange_name: str) -> Dict:
+        """Chiude la posizione verificandola prima sull'exchange"""
+        return manager._close_standard_position(exchange, exchange_name)
+
+
+class BitfinexStrategy(ExchangeStrategy):
+    name = "bitfinex"
+    
+    def apply_leverage(self, exchange, symbol: str, leverage: float, params: Dict) -> None:
+        # Bitfinex: passa leva come parametro 'lev' (int) secondo documentazione CCXT
+        # Validazione: deve essere tra 1 e 100 inclusi
+        lev_int = max(1, min(100, int(leverage)))
+        params['lev'] = lev_int
+        if lev_int != int(leverage):
+            logger.warning(f"Bitfinex: leva {leverage} aggiustata a {lev_int} (range supportato: 1-100)")
+        logger.info(f"Bitfinex: leva {lev_int}x passata come parametro 'lev'")
+
+
+class BitmexStrategy(ExchangeStrategy):
+    name = "bitmex"
+    multiplier = EXCHANGE_MULTIPLIERS["bitmex"]
+    
+    def size(self, sol_amount: float) -> float:
+        # BitMEX: converti SOL in contratti, minimo 1000, arrotondati a centinaia (aritmetica intera)
+        contracts = int(sol_amount * self.multiplier)
+        contracts = (max(contracts, 1000) + 50) // 100 * 100
+        logger.info(f"BitMEX size conversion: {sol_amount} SOL → {contracts} contratti")
+        return contracts
+    
+    def apply_leverage(self, exchange, symbol: str, leverage: float, params: Dict) -> None:
+        # BitMEX: imposta leva prima dell'ordine
+        try:
+            exchange.set_leverage(leverage, symbol)
+            logger.info(f"BitMEX: leva {leverage}x impostata per {symbol}")
+        except Exception as lev_error:
+            logger.warning(f"BitMEX: impossibile impostare leva {leverage}x: {lev_error}")
+        
+        # BitMEX: imposta margine isolato
+        try:
+            exchange.set_position_parameters(symbol, margin_mode='isolated')
+            logger.info(f"BitMEX: margine isolato impostato per {symbol}")
+        except Exception as margin_error:
+            logger.warning(f"BitMEX: impossibile impostare margine isolato: {margin_error}")
+    
+    def close(self, manager: "ExchangeManager", exchange, exchange_name: str) -> Dict:
+        # Gestione speciale per Bitmex
+        return manager._close_bitmex_position(exchange)
+
+
+# Strategie per nome exchange normalizzato; gli exchange non elencati usano quella di default
+_STRATEGIES: Dict[str, ExchangeStrategy] = {
+    strategy.name: strategy for strategy in (BitfinexStrategy(), BitmexStrategy())
+}
+_DEFAULT_STRATEGY = ExchangeStrategy()
+
+
+@functools.lru_cache(maxsize=8)
+def _exchange_symbol(exchange_name: str) -> str:
+    return EXCHANGE_SYMBOLS.get(exchange_name.lower(), "SOL/USDT")
+
+
+def get_exchange_strategy(exchange_name: str) -> ExchangeStrategy:
+    """Restituisce la strategia dell'exchange (default se non specifica)"""
+    return _STRATEGIES.get(exchange_name.lower(), _DEFAULT_STRATEGY)
+
+
 class ExchangeManager:
     """Manager per operazioni con gli exchange"""
     
+    # Metadati dei mercati per exchange (markets, currencies), condivisi tra istanze:
+    # sono statici durante l'esecuzione e vengono scaricati una sola volta
+    _markets_cache: Dict[str, Tuple[dict, dict]] = {}
+    _markets_lock = threading.Lock()
+    
+    # Client CCXT già inizializzati per (exchange, impronta credenziali, thread proprietario):
+    # (istante monotonic, client). I client sync CCXT non sono thread-safe (sessione,
+    # rate limiter, last_*), quindi un client è riusato solo dal thread che lo ha creato
+    _client_cache: Dict[Tuple[str, str, int], Tuple[float, object]] = {}
+    _client_lock = threading.Lock()
+    
+    # Ultimo prezzo SOLANA per exchange: (istante monotonic, prezzo)
+    _price_cache: Dict[str, Tuple[float, float]] = {}
+    
     def __init__(self):
         self.exchanges = {}
+        # Thread del bot che usa questo manager (anche se inizializza i client da worker annidati)
+        self._owner_thread = threading.get_ident()
     
     def get_exchange_symbol(self, exchange_name: str) -> str:
         """Ottiene il simbolo futures perpetual corretto per l'exchange"""
-        return EXCHANGE_SYMBOLS.get(exchange_name.lower(), "SOL/USDT")
+        return _exchange_symbol(exchange_name)
     
     def calculate_exchange_size(self, exchange_name: str, sol_amount: float) -> float:
         """Calcola la size appropriata per l'exchange specifico"""
-        multiplier = EXCHANGE_MULTIPLIERS.get(exchange_name.lower(), 1)
-        
-        if exchange_name.lower() == "bitmex":
-            # BitMEX: converti SOL in contratti e arrotonda a centinaia
-            contracts = int(sol_amount * multiplier)
-            contracts = max(contracts, 1000)  # Minimo 1000 contratti
-            contracts = round(contracts / 100) * 100  # Arrotonda a centinaia
-            logger.info(f"BitMEX size conversion: {sol_amount} SOL → {contracts} contratti")
-            return contracts
-        else:
-            # Bitfinex: usa size normale
-            return sol_amount
+        return get_exchange_strategy(exchange_name).size(sol_amount)
+    
+    @staticmethod
+    def _client_key(exchange_name: str, api_key: str, api_secret: str) -> Tuple[str, str]:
+        """Chiave di cache del client: exchange + impronta delle credenziali"""
+        fingerprint = hashlib.blake2b(f"{api_key}:{api_secret}".encode('utf-8'), digest_size=8).hexdigest()
+        return exchange_name, fingerprint
+    
+    def _get_cached_client(self, key: Tuple[str, str, int]):
+        """Restituisce il client in cache se ancora valido, altrimenti None"""
+        with self._client_lock:
+            entry = self._client_cache.get(key)
+            if entry is None:
+                return None
+            created_at, exchange = entry
+            if time.monotonic() - created_at >= CLIENT_CACHE_TTL:
+                del self._client_cache[key]
+                return None
+            return exchange
+    
+    def _store_client(self, key: Tuple[str, str, int], exchange) -> None:
+        """Salva un client in cache, rimuovendo il più vecchio oltre CLIENT_CACHE_MAXSIZE"""
+        with self._client_lock:
+            self._client_cache[key] = (time.monotonic(), exchange)
+            if len(self._client_cache) > CLIENT_CACHE_MAXSIZE:
+                oldest = min(self._client_cache, key=lambda k: self._client_cache[k][0])
+                del self._client_cache[oldest]
+    
+    def invalidate_exchange(self, exchange_name: str) -> None:
+        """Rimuove dalla cache il client dell'exchange (es. dopo un errore di autenticazione)"""
+        exchange = self.exchanges.get(exchange_name)
+        if exchange is None:
+            return
+        with self._client_lock:
+            for key in [k for k, (_, v) in self._client_cache.items() if v is exchange]:
+                del self._client_cache[key]
     
     def initialize_exchange(self, exchange_name: str, api_key: str, api_secret: str) -> bool:
-        """Inizializza connessione exchange con gestione ottimizzata"""
+        """Inizializza connessione exchange con gestione ottimizzata
+        
+        Se un client per lo stesso exchange e le stesse credenziali è già stato
+        inizializzato dallo stesso thread (e non è scaduto), viene riusato senza nuove chiamate.
+        """
         try:
+            client_key = (*self._client_key(exchange_name, api_key, api_secret), self._owner_thread)
+            cached_exchange = self._get_cached_client(client_key)
+            if cached_exchange is not None:
+                self.exchanges[exchange_name] = cached_exchange
+                logger.debug("Exchange %s riusato dalla cache", exchange_name)
+                return True
+            
             # Ottieni configurazione specifica per exchange
             config = get_exchange_config(exchange_name)
             
@@ -48,12 +217,13 @@ class ExchangeManager:
                     'sandbox': False,
                     'enableRateLimit': True,
                     'timeout': 30000,  # 30 secondi timeout
-                    'options': config.get('options', {})
+                    'options': config.get('options', {}),
+                    'session': _new_session()
                 }
                 
                 # Aggiungi nonce dinamico per Bitfinex
                 if config.get('requires_nonce'):
-                    exchange_config['nonce'] = lambda: int(time.time() * 1000)
+                    exchange_config['nonce'] = ExchangeUtils.get_bitfinex_nonce
                 
                 exchange = ccxt.bitfinex(exchange_config)
                 
@@ -64,7 +234,8 @@ class ExchangeManager:
                     'sandbox': False,
                     'enableRateLimit': True,
                     'timeout': 30000,  # 30 secondi timeout
-                    'options': config.get('options', {})
+                    'options': config.get('options', {}),
+                    'session': _new_session()
                 }
                 
                 exchange = ccxt.bitmex(exchange_config)
@@ -73,14 +244,26 @@ class ExchangeManager:
                 logger.error(f"Exchange non supportato: {exchange_name}")
                 return False
             
-            # Test connessione con retry per gestire problemi di nonce
-            def test_connection():
-                exchange.load_markets()
-                return exchange
+            with self._markets_lock:
+                cached_markets = self._markets_cache.get(exchange_name)
             
-            exchange = ExchangeUtils.retry_with_nonce_fix(test_connection, max_retries=3, wait_seconds=2)
+            if cached_markets:
+                # Riusa i mercati già scaricati per questo exchange
+                markets, currencies = cached_markets
+                exchange.set_markets(markets, currencies)
+            else:
+                # Test connessione con retry per gestire problemi di nonce
+                def test_connection():
+                    exchange.load_markets()
+                    return exchange
+                
+                exchange = ExchangeUtils.retry_with_nonce_fix(test_connection, max_retries=3, wait_seconds=2)
+                
+                with self._markets_lock:
+                    self._markets_cache[exchange_name] = (exchange.markets, exchange.currencies)
             
             self.exchanges[exchange_name] = exchange
+            self._store_client(client_key, exchange)
             logger.info(f"Exchange {exchange_name} inizializzato con successo")
             return True
             
@@ -94,16 +277,22 @@ class ExchangeManager:
             return False
     
     def get_solana_price(self, exchange_name: str) -> Optional[float]:
-        """Ottiene prezzo corrente SOLANA"""
+        """Ottiene prezzo corrente SOLANA (riusa il prezzo letto da meno di PRICE_CACHE_TTL secondi)"""
         try:
             exchange = self.exchanges.get(exchange_name)
             if not exchange:
                 logger.error(f"Exchange {exchange_name} non inizializzato")
                 return None
             
+            cached = self._price_cache.get(exchange_name)
+            if cached is not None and time.monotonic() - cached[0] < PRICE_CACHE_TTL:
+                return cached[1]
+            
             symbol = self.get_exchange_symbol(exchange_name)
             ticker = exchange.fetch_ticker(symbol)
             price = ticker['last']
+            if price:
+                self._price_cache[exchange_name] = (time.monotonic(), price)
             logger.info(f"Prezzo SOLANA su {exchange_name}: {price}")
             return price
             
@@ -149,38 +338,17 @@ class ExchangeManager:
                 logger.error(f"Exchange {exchange_name} non inizializzato")
                 return None
             
+            strategy = get_exchange_strategy(exchange_name)
+            
             # Ottieni simbolo corretto per l'exchange
             symbol = self.get_exchange_symbol(exchange_name)
             
             # Calcola size appropriata per l'exchange
-            exchange_size = self.calculate_exchange_size(exchange_name, sol_amount)
+            exchange_size = strategy.size(sol_amount)
             
             # Gestione leva specifica per exchange
             order_params = {}
-            
-            if exchange_name.lower() == "bitfinex":
-                # Bitfinex: passa leva come parametro 'lev' (int) secondo documentazione CCXT
-                # Validazione: deve essere tra 1 e 100 inclusi
-                lev_int = max(1, min(100, int(leverage)))
-                order_params['lev'] = lev_int
-                if lev_int != int(leverage):
-                    logger.warning(f"Bitfinex: leva {leverage} aggiustata a {lev_int} (range supportato: 1-100)")
-                logger.info(f"Bitfinex: leva {lev_int}x passata come parametro 'lev'")
-                
-            elif exchange_name.lower() == "bitmex":
-                # BitMEX: imposta leva prima dell'ordine
-                try:
-                    exchange.set_leverage(leverage, symbol)
-                    logger.info(f"BitMEX: leva {leverage}x impostata per {symbol}")
-                except Exception as lev_error:
-                    logger.warning(f"BitMEX: impossibile impostare leva {leverage}x: {lev_error}")
-                
-                # BitMEX: imposta margine isolato
-                try:
-                    exchange.set_position_parameters(symbol, margin_mode='isolated')
-                    logger.info(f"BitMEX: margine isolato impostato per {symbol}")
-                except Exception as margin_error:
-                    logger.warning(f"BitMEX: impossibile impostare margine isolato: {margin_error}")
+            strategy.apply_leverage(exchange, symbol, leverage, order_params)
             
             # Crea ordine di mercato
             order = exchange.create_market_order(symbol, side, exchange_size, None, order_params)
@@ -212,19 +380,79 @@ class ExchangeManager:
             logger.error(f"Errore recupero posizione {exchange_name}: {e}")
             return None
     
-    def close_position(self, exchange_name: str) -> Dict:
-        """Chiude posizione aperta"""
+    def get_liquidation_price(self, exchange_name: str, symbol: str, side: str) -> Optional[float]:
+        """Recupera liquidation price della posizione aperta dalle API dell'exchange
+        
+        Args:
+            exchange_name: Nome dell'exchange
+            symbol: Simbolo trading
+            side: "long" o "short"
+            
+        Returns:
+            float: Liquidation price o None se non disponibile
+        
+        Le eccezioni delle API vengono propagate al chiamante.
+        """
+        exchange = self.exchanges.get(exchange_name)
+        if not exchange:
+            return None
+        
+        # Per BitMEX usa logica specifica con fetch_positions()
+        if exchange_name.lower() == 'bitmex':
+            # Con il symbol l'exchange restituisce solo la posizione interessata
+            positions = exchange.fetch_positions([symbol]) if symbol else exchange.fetch_positions()
+            # Posizioni aperte per (symbol, side); BitMEX usa 'contracts' invece di 'size'
+            open_positions = {
+                (pos.get('symbol'), (pos.get('side') or '').lower()): pos
+                for pos in positions
+                if pos.get('contracts') or pos.get('size')
+            }
+            pos = open_positions.get((symbol, side.lower()))
+            liquidation_price = pos.get('liquidationPrice') if pos else None
+        else:
+            # Altri exchange: usa get_position() (metodo testato)
+            position = self.get_position(exchange_name)
+            liquidation_price = position.get('liquidationPrice') if position else None
+        
+        if not liquidation_price:
+            return None
+        
+        logger.info(f"Liquidation price recuperato da {exchange_name}: {liquidation_price}")
+        return float(liquidation_price)
+    
+    def close_position(self, exchange_name: str, position_dict: Optional[Dict] = None, strict: bool = False) -> Dict:
+        """Chiude posizione aperta
+        
+        Se viene passata la posizione del database (symbol, side, size) l'ordine di chiusura
+        reduce-only viene inviato direttamente, senza recuperare prima la posizione
+        dall'exchange; se l'exchange lo rifiuta si ripiega sul percorso con verifica.
+        
+        Con strict=True si chiude solo la quantità di position_dict: se l'ordine reduce-only
+        fallisce non si ripiega sulla chiusura di tutte le posizioni dell'exchange.
+        """
         try:
             exchange = self.exchanges.get(exchange_name)
             if not exchange:
                 logger.error(f"Exchange {exchange_name} non inizializzato")
                 return {"success": False, "message": "exchange_not_initialized", "error": "Exchange non inizializzato"}
             
-            # Gestione speciale per Bitmex
-            if exchange_name.lower() == "bitmex":
-                return self._close_bitmex_position(exchange)
+            if position_dict:
+                result = self._close_known_position(exchange, exchange_name, position_dict)
+                if result:
+                    return result
             
-            # Gestione standard per altri exchange
+            if strict:
+                return {"success": False, "message": "close_failed", "error": "Chiusura reduce-only non riuscita"}
+            
+            return get_exchange_strategy(exchange_name).close(self, exchange, exchange_name)
+            
+        except Exception as e:
+            logger.error(f"Errore chiusura posizione {exchange_name}: {e}")
+            return {"success": False, "message": "exception", "error": str(e)}
+    
+    def _close_standard_position(self, exchange, exchange_name: str) -> Dict:
+        """Chiude la posizione recuperandola prima dall'exchange"""
+        try:
             position = self.get_position(exchange_name)
             if not position:
                 logger.info(f"Nessuna posizione da chiudere su {exchange_name}")
@@ -242,15 +470,16 @@ class ExchangeManager:
             # Determina side opposto per chiudere
             side = 'sell' if position['side'] == 'long' else 'buy'
             
-            # Calcola amount in SOL e poi converti per l'exchange
+            # Amount in SOL (BitMEX è gestito dalla sua strategia)
             sol_amount = abs(position_size)
-            if exchange_name.lower() == "bitmex":
-                # Converti contratti BitMEX in SOL
-                sol_amount = sol_amount / EXCHANGE_MULTIPLIERS["bitmex"]
             
             # Crea ordine di chiusura usando il simbolo corretto
             logger.info(f"Chiusura {side} {sol_amount} {symbol} su {exchange_name}")
-            order = exchange.create_market_order(symbol, side, sol_amount)
+            if _implements(exchange, 'close_position'):
+                # Chiusura nativa: l'exchange usa la size reale della posizione
+                order = exchange.close_position(symbol, position['side'])
+            else:
+                order = exchange.create_market_order(symbol, side, sol_amount)
             if order:
                 logger.info(f"Posizione chiusa su {exchange_name}")
                 return {"success": True, "message": "position_closed", "order": order}
@@ -261,6 +490,35 @@ class ExchangeManager:
             logger.error(f"Errore chiusura posizione {exchange_name}: {e}")
             return {"success": False, "message": "exception", "error": str(e)}
             
+    def _close_known_position(self, exchange, exchange_name: str, position_dict: Dict) -> Optional[Dict]:
+        """
+        Chiude una posizione nota dal database con un solo ordine reduce-only
+        
+        Args:
+            exchange: Istanza dell'exchange
+            exchange_name: Nome dell'exchange
+            position_dict: Posizione del database (symbol, side "long"/"short", size in unità exchange)
+            
+        Returns:
+            dict: Risultato della chiusura, None se serve il percorso con verifica
+        """
+        symbol = position_dict.get('symbol')
+        side = position_dict.get('side')
+        size = abs(float(position_dict.get('size') or 0))
+        if not symbol or side not in ('long', 'short') or size == 0:
+            return None
+        
+        close_side = 'sell' if side == 'long' else 'buy'
+        try:
+            # reduceOnly: se la posizione non esiste più l'exchange rifiuta l'ordine invece di aprirne una opposta
+            order = exchange.create_market_order(symbol, close_side, size, None, {'reduceOnly': True})
+        except Exception as e:
+            logger.warning(f"Chiusura diretta {symbol} su {exchange_name} rifiutata, verifico la posizione: {e}")
+            return None
+        
+        logger.info(f"Posizione chiusa su {exchange_name}: {close_side} {size} {symbol}")
+        return {"success": True, "message": "position_closed", "order": order}
+    
     def _close_bitmex_position(self, exchange) -> Dict:
         """
         Chiude posizioni aperte su Bitmex con gestione speciale
@@ -294,6 +552,15 @@ class ExchangeManager:
                 logger.info("Nessuna posizione aperta trovata su Bitmex")
                 return {"success": True, "message": "no_position", "order": None}
             
+            # Chiusura nativa di tutte le posizioni con una sola chiamata, se implementata
+            if _implements(exchange, 'close_all_positions'):
+                try:
+                    orders = exchange.close_all_positions()
+                    logger.info(f"Chiuse {len(open_positions)} posizioni su Bitmex con closeAllPositions")
+                    return {"success": True, "message": "position_closed", "order": orders}
+                except Exception as e:
+                    logger.warning(f"closeAllPositions Bitmex fallita, chiusura per posizione: {e}")
+            
             # Log delle posizioni trovate
             logger.info(f"Trovate {len(open_positions)} posizioni aperte su Bitmex:")
             for pos in open_positions:
@@ -322,12 +589,16 @@ class ExchangeManager:
                 logger.info(f"Chiusura posizione {side} {contracts} {symbol} con {close_side}")
                 
                 try:
-                    # Crea ordine di mercato per chiudere
-                    order = exchange.create_market_order(
-                        symbol=symbol,
-                        side=close_side,
-                        amount=abs(contracts)
-                    )
+                    if _implements(exchange, 'close_position'):
+                        # Chiusura nativa: l'exchange usa la size reale della posizione
+                        order = exchange.close_position(symbol, side)
+                    else:
+                        # Crea ordine di mercato per chiudere
+                        order = exchange.create_market_order(
+                            symbol=symbol,
+                            side=close_side,
+                            amount=abs(contracts)
+                        )
                     
                     logger.info(f"Ordine di chiusura creato: {order}")
                     orders.append(order)
@@ -1,96 +1,288 @@
 """Modulo Opener - Esegue operazioni di trading per bot con status 'ready'"""
+import atexit
+import functools
+import gzip
 import time
 import logging
 import os
 import math
-from typing import Dict, List
-from datetime import datetime
+import queue
+import shutil
+import threading
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from itertools import islice
 from database.models import db_manager, user_manager, bot_manager, position_manager
-from trading.exchange_manager import exchange_manager
+from trading.exchange_manager import ExchangeManager
 from config.settings import BOT_STATUS
 
 # Crea directory logs se non esiste
 os.makedirs("logs", exist_ok=True)
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(f"logs/opener_{datetime.now().strftime('%Y%m%d')}.log"),
-        logging.StreamHandler()
-    ]
+def _gzip_rotator(source: str, dest: str) -> None:
+    """Comprime il file di log ruotato (eseguito nel thread del listener)"""
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+# File di log giornaliero: rotazione a mezzanotte senza riavvio, 30 giorni compressi
+_log_file_handler = TimedRotatingFileHandler("logs/opener.log", when="midnight", backupCount=30, encoding="utf-8")
+_log_file_handler.namer = lambda name: name + ".gz"
+_log_file_handler.rotator = _gzip_rotator
+
+# Setup logging del solo logger del modulo (il root logger resta a chi lo ha configurato):
+# i worker accodano i record già formattati, la scrittura su file e console avviene
+# in un thread dedicato
+_log_queue = queue.Queue(-1)
+_log_queue_handler = QueueHandler(_log_queue)
+_log_queue_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_listener = QueueListener(
+    _log_queue,
+    _log_file_handler,
+    logging.StreamHandler()
 )
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(_log_queue_handler)
+logger.propagate = False  # file e console sono già gestiti dal listener
+
+@dataclass(slots=True)
+class CapitalCheck:
+    """Esito di check_capital_requirements"""
+    exchange_long: str
+    exchange_short: str
+    required_total: float        # Capitale totale richiesto (per exchange x 2)
+    long_balance: float = 0.0
+    short_balance: float = 0.0
+    total_capital: float = 0.0
+    overall_success: bool = False
+    needs_transfer: bool = False   # Capitale totale sufficiente ma mal distribuito tra exchange
+
+
+# Numero massimo di bot avviati in parallelo (operazioni dominate dalla latenza di rete)
+MAX_WORKERS = 8
+
+# Bot letti dal cursore (e API keys caricate) per blocco
+BOT_BATCH_SIZE = 64
+
+# Campi della risposta ordine che possono contenere il liquidation price
+_ORDER_LIQ_PRICE_FIELDS = ('liquidationPrice', 'liqPrice', 'liqPx', 'bankruptPrice')
+
+# Valuta USDT di ciascun wallet Bitfinex nei trasferimenti interni (default: UST)
+_BFX_WALLET_CURRENCY = {"margin": "USTF0", "exchange": "UST", "funding": "UST"}
+
+
+@functools.lru_cache(maxsize=16)
+def _required_api_keys(exchange_long: str, exchange_short: str) -> Tuple[str, ...]:
+    """Nomi dei campi API key/secret richiesti per una coppia di exchange"""
+    return (
+        f"{exchange_long}_api_key",
+        f"{exchange_long}_api_secret",
+        f"{exchange_short}_api_key",
+        f"{exchange_short}_api_secret"
+    )
+
+
+def _bitfinex_available(rows, wallets, currencies) -> List[Tuple[str, str, float]]:
+    """
+    Filtra le righe wallet Bitfinex [wallet, valuta, saldo, interessi, disponibile, ...]
+    
+    Args:
+        rows: Righe restituite da Bitfinex (array 'info' o auth/r/wallets)
+        wallets: Wallet da considerare
+        currencies: Valute da considerare
+        
+    Returns:
+        Lista (wallet, valuta, disponibile) con disponibile > 0
+    """
+    return [
+        (row[0], row[1], available)
+        for row in rows
+        if len(row) >= 5 and row[0] in wallets and row[1] in currencies
+        and (available := float(row[4] or 0)) > 0
+    ]
 
 class TradingOpener:
     """Classe principale per apertura posizioni"""
     
+    # Quota minima del capitale configurato accettata per bot READY (tolleranza 2%)
+    _READY_CAPITAL_TOLERANCE = 0.98
+    # Quota minima dell'importo richiesto per exchange e per trasferimento (tolleranza 1%)
+    _DISTRIBUTION_TOLERANCE = 0.99
+    
+    # Esiti della strategia che non cambiano lo stato del bot: (livello di log, messaggio)
+    _RESULT_MESSAGES = {
+        # Capitale totale insufficiente - bot già fermato da _handle_balance_failure
+        "insufficient_capital": (logging.WARNING, "capitale totale insufficiente"),
+        # Bot TRANSFERING con capitale insufficiente - mantiene stato
+        "insufficient_capital_transfering": (logging.WARNING, "capitale insufficiente, mantengo TRANSFERING"),
+        # Capitale sufficiente ma mal distribuito - bot già marcato per trasferimento
+        "transfer_requested": (logging.INFO, "richiesto trasferimento per redistribuzione"),
+        # Bot TRANSFERING con capitale mal distribuito - mantiene stato
+        "transfer_in_progress": (logging.INFO, "capitale mal distribuito, mantengo TRANSFERING"),
+        # Bot TRANSFERING fermato per stop loss - già gestito in execute_trading_strategy
+        "stop_loss_triggered": (logging.WARNING, "fermato per stop loss"),
+    }
+    
+    # Risultati che fermano il bot con il risultato stesso come stopped_type
+    _STOP_RESULTS = frozenset({"leverage_insufficient"})
+    
     def __init__(self):
         self.running = False
-        self.exchange_manager = exchange_manager
+        # ExchangeManager per thread: ogni worker usa le API keys del proprio bot
+        self._local = threading.local()
+    
+    @property
+    def exchange_manager(self) -> ExchangeManager:
+        """ExchangeManager del thread corrente (creato alla prima richiesta)"""
+        manager = getattr(self._local, "exchange_manager", None)
+        if manager is None:
+            manager = ExchangeManager()
+            self._local.exchange_manager = manager
+        return manager
+    
+    def _in_bot_context(self, func):
+        """Avvolge func perché nei worker usi l'ExchangeManager del bot corrente
+        
+        L'ExchangeManager è per-thread: va risolto nel thread del bot (qui) e
+        riassegnato nel worker prima della chiamata.
+        """
+        manager = self.exchange_manager
+        
+        def run(*args, **kwargs):
+            self._local.exchange_manager = manager
+            return func(*args, **kwargs)
+        
+        return run
     
     def process_ready_bots(self) -> None:
         """Processa tutti i bot con status 'ready' o 'transfering'"""
         logger.info("Scansione bot con status 'ready' o 'transfering'...")
         
-        ready_bots = bot_manager.get_ready_bots()
-        logger.info(f"Trovati {len(ready_bots)} bot pronti")
+        # Stop per errore accumulati e scritti con un solo bulk_write a fine scansione
+        pending_updates = []
+        ready_count = 0
         
-        for bot in ready_bots:
-            try:
-                bot_status = bot.get('status')
-                if bot_status == BOT_STATUS["TRANSFERING"]:
-                    # Processa solo bot TRANSFERING con transfer_reason 'emergency_close' o 'first_start'
-                    transfer_reason = bot.get('transfer_reason')
-                    if transfer_reason not in ['emergency_close', 'first_start']:
-                        logger.info(f"Bot TRANSFERING utente {bot['user_id']} saltato (reason: {transfer_reason})")
-                        continue
-                    logger.info(f"Processando bot TRANSFERING utente: {bot['user_id']} (reason: {transfer_reason})")
-                else:
-                    logger.info(f"Processando bot READY utente: {bot['user_id']}")
-                    
-                result = self.execute_trading_strategy(bot)
+        # Bot letti in streaming dal cursore a blocchi di BOT_BATCH_SIZE e processati in parallelo:
+        # le chiamate REST di bot diversi si sovrappongono
+        ready_bots = bot_manager.iter_ready_bots(BOT_BATCH_SIZE)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            while True:
+                batch = list(islice(ready_bots, BOT_BATCH_SIZE))
+                if not batch:
+                    break
+                ready_count += len(batch)
                 
-                if result == "success":
-                    # Controlla se transfer_reason è "first_start" o "emergency_close" per impostarlo a "null"
-                    current_transfer_reason = bot.get('transfer_reason')
-                    new_transfer_reason = "null" if current_transfer_reason in ["first_start", "emergency_close"] else "waiting"
-                    
-                    # Aggiorna status a running con timestamp started_at e transfer_reason appropriato
-                    bot_manager.update_bot_status(bot['user_id'], BOT_STATUS["RUNNING"], transfer_reason=new_transfer_reason)
-                    logger.info(f"Bot {bot['user_id']} avviato con successo (transfer_reason: {current_transfer_reason} -> {new_transfer_reason})")
-                elif result == "insufficient_capital":
-                    # Capitale totale insufficiente - bot già fermato da _handle_balance_failure
-                    logger.warning(f"Bot {bot['user_id']}: capitale totale insufficiente")
-                elif result == "insufficient_capital_transfering":
-                    # Bot TRANSFERING con capitale insufficiente - mantiene stato
-                    logger.warning(f"Bot {bot['user_id']}: capitale insufficiente, mantengo TRANSFERING")
-                elif result == "transfer_requested":
-                    # Capitale sufficiente ma mal distribuito - bot già marcato per trasferimento
-                    logger.info(f"Bot {bot['user_id']}: richiesto trasferimento per redistribuzione")
-                elif result == "transfer_in_progress":
-                    # Bot TRANSFERING con capitale mal distribuito - mantiene stato
-                    logger.info(f"Bot {bot['user_id']}: capitale mal distribuito, mantengo TRANSFERING")
-                elif result == "stop_loss_triggered":
-                    # Bot TRANSFERING fermato per stop loss - già gestito in execute_trading_strategy
-                    logger.warning(f"Bot {bot['user_id']}: fermato per stop loss")
-                else:
-                    # Altri errori - ferma il bot solo se non è TRANSFERING
-                    if bot_status != BOT_STATUS["TRANSFERING"]:
-                        bot_manager.update_bot_status(bot['user_id'], BOT_STATUS["STOPPED"], "error")
-                        logger.error(f"Errore avvio bot {bot['user_id']}")
-                    else:
-                        logger.error(f"Errore bot TRANSFERING {bot['user_id']}, mantengo stato")
-                    
-            except Exception as e:
-                logger.error(f"Errore processamento bot {bot['user_id']}: {e}")
-                # Non fermare bot TRANSFERING in caso di errore generico
-                if bot.get('status') != BOT_STATUS["TRANSFERING"]:
-                    bot_manager.update_bot_status(bot['user_id'], BOT_STATUS["STOPPED"], "error")
+                # API keys del blocco con una sola query (se manca un utente il bot le rilegge da solo)
+                api_keys_by_user = user_manager.get_users_api_keys([bot['user_id'] for bot in batch])
+                futures = [
+                    executor.submit(self._process_single_bot, bot, api_keys_by_user.get(str(bot['user_id'])))
+                    for bot in batch
+                ]
+                for future in as_completed(futures):
+                    bot, result = future.result()
+                    if result is not None:
+                        self._apply_bot_result(bot, result, pending_updates)
+        
+        logger.info(f"Processati {ready_count} bot pronti")
+        bot_manager.bulk_update_bots(pending_updates)
     
-    def execute_trading_strategy(self, bot_config: Dict) -> str:
-        """Esegue strategia di trading per un bot specifico"""
+    def _process_single_bot(self, bot: Dict, api_keys: Optional[Dict] = None) -> Tuple[Dict, object]:
+        """
+        Esegue la strategia di un bot (in un worker del pool)
+        
+        Args:
+            bot: Dati del bot
+            api_keys: API keys dell'utente già recuperate (se None vengono lette dal database)
+            
+        Returns:
+            Tupla (bot, risultato della strategia), risultato None se il bot è stato saltato
+            o l'errore è già stato gestito
+        """
+        try:
+            bot_status = bot.get('status')
+            if bot_status == BOT_STATUS["TRANSFERING"]:
+                # Processa solo bot TRANSFERING con transfer_reason 'emergency_close' o 'first_start'
+                transfer_reason = bot.get('transfer_reason')
+                if transfer_reason not in ['emergency_close', 'first_start']:
+                    logger.info(f"Bot TRANSFERING utente {bot['user_id']} saltato (reason: {transfer_reason})")
+                    return bot, None
+                logger.info(f"Processando bot TRANSFERING utente: {bot['user_id']} (reason: {transfer_reason})")
+            else:
+                logger.info(f"Processando bot READY utente: {bot['user_id']}")
+            
+            # ExchangeManager nuovo per il bot: nessun client di bot precedenti sullo stesso thread
+            self._local.exchange_manager = ExchangeManager()
+            return bot, self.execute_trading_strategy(bot, api_keys)
+        except Exception as e:
+            self._handle_bot_exception(bot, e)
+            return bot, None
+    
+    def _handle_bot_exception(self, bot: Dict, e: Exception) -> None:
+        """Registra l'errore di un bot e lo ferma se non è TRANSFERING"""
+        logger.error(f"Errore processamento bot {bot['user_id']}: {e}")
+        # Non fermare bot TRANSFERING in caso di errore generico
+        if bot.get('status') != BOT_STATUS["TRANSFERING"]:
+            bot_manager.update_bot_status(bot['user_id'], BOT_STATUS["STOPPED"], "error")
+    
+    def _apply_bot_result(self, bot: Dict, result, pending_updates: List) -> None:
+        """
+        Aggiorna lo stato del bot in base al risultato della strategia
+        
+        Il passaggio a RUNNING è scritto subito (le posizioni sono già aperte e il bot non
+        deve essere riaperto alla scansione successiva); gli stop per errore vengono
+        accodati in pending_updates.
+        
+        Args:
+            bot: Dati del bot
+            result: Risultato di execute_trading_strategy
+            pending_updates: Aggiornamenti differiti per bulk_update_bots
+        """
+        user_id = bot['user_id']
+        try:
+            if result == "success":
+                # Controlla se transfer_reason è "first_start" o "emergency_close" per impostarlo a "null"
+                current_transfer_reason = bot.get('transfer_reason')
+                new_transfer_reason = "null" if current_transfer_reason in ["first_start", "emergency_close"] else "waiting"
+                
+                # Aggiorna status a running con timestamp started_at e transfer_reason appropriato
+                bot_manager.update_bot_status(user_id, BOT_STATUS["RUNNING"], transfer_reason=new_transfer_reason)
+                logger.info(f"Bot {user_id} avviato con successo (transfer_reason: {current_transfer_reason} -> {new_transfer_reason})")
+                return
+            
+            message = self._RESULT_MESSAGES.get(result)
+            if message is not None:
+                level, text = message
+                logger.log(level, f"Bot {user_id}: {text}")
+            elif result in self._STOP_RESULTS:
+                # Gamba singola già chiusa: il bot va fermato anche se TRANSFERING
+                pending_updates.append(bot_manager.bot_status_update(bot['_id'], BOT_STATUS["STOPPED"], result))
+                logger.error(f"Bot {user_id} fermato: {result}")
+            elif bot.get('status') != BOT_STATUS["TRANSFERING"]:
+                # Altri errori - ferma il bot solo se non è TRANSFERING
+                pending_updates.append(bot_manager.bot_status_update(bot['_id'], BOT_STATUS["STOPPED"], "error"))
+                logger.error(f"Errore avvio bot {user_id}")
+            else:
+                logger.error(f"Errore bot TRANSFERING {user_id}, mantengo stato")
+                
+        except Exception as e:
+            self._handle_bot_exception(bot, e)
+    
+    def execute_trading_strategy(self, bot_config: Dict, api_keys: Optional[Dict] = None) -> str:
+        """Esegue strategia di trading per un bot specifico
+        
+        Args:
+            bot_config: Dati del bot
+            api_keys: API keys dell'utente già recuperate (se None vengono lette dal database)
+        """
+        # Motivo di stop impostato da create_new_positions (per thread, valido per questo bot)
+        self._local.stop_reason = None
         try:
             user_id = bot_config['user_id']
             exchange_long = bot_config['exchange_long']
@@ -110,9 +302,15 @@ class TradingOpener:
             
             logger.info(f"Configurazione bot: Long={exchange_long}, Short={exchange_short}, Capital={capital}, Leverage={leverage}, Status={bot_status}, Increment={is_increment}")
             
+            # Controlli locali sulla configurazione prima di qualsiasi chiamata a DB o exchange
+            if not capital or capital <= 0 or not leverage or leverage <= 0 or exchange_long == exchange_short:
+                logger.error(f"Configurazione bot non valida: capital={capital}, leverage={leverage}, long={exchange_long}, short={exchange_short}")
+                return "config_error"
+            
             # Recupera API keys utente
-            api_keys = user_manager.get_user_api_keys(user_id)
-            if not self.validate_api_keys(api_keys, exchange_long, exchange_short):
+            if api_keys is None:
+                api_keys = user_manager.get_user_api_keys(user_id)
+            if not api_keys or not self.validate_api_keys(api_keys, exchange_long, exchange_short):
                 logger.error("API keys mancanti o non valide")
                 return False
             
@@ -123,8 +321,7 @@ class TradingOpener:
             
             # CONTROLLO CAPITALE TOTALE E DISTRIBUZIONE
             # Prima calcola available_balance (somma dei bilanci attuali)
-            long_balance = self._get_exchange_balance(exchange_long, balance_type='total')
-            short_balance = self._get_exchange_balance(exchange_short, balance_type='total')
+            long_balance, short_balance = self._fetch_total_balances(exchange_long, exchange_short)
             available_balance = long_balance + short_balance
             
             logger.info(f"Capitale configurato: {capital} USDT")
@@ -183,8 +380,7 @@ class TradingOpener:
                 logger.info(f"   Distribuzione richiesta: {capital_per_exchange_check} USDT per exchange")
             elif bot_status == BOT_STATUS["READY"]:
                 # Logica READY: Applica tolleranza del 2% sul capitale configurato
-                tolerance_percentage = 2.0  # 2% di tolleranza
-                min_capital_with_tolerance = capital * (1 - tolerance_percentage / 100)
+                min_capital_with_tolerance = capital * self._READY_CAPITAL_TOLERANCE
                 
                 if available_balance >= min_capital_with_tolerance:
                     # Se available_balance è almeno il 98% del capitale, usa available_balance per il controllo
@@ -208,8 +404,9 @@ class TradingOpener:
             logger.info(f"Capitale con leva per exchange: {capital_with_leverage} USDT (per ordini)")
             
             # Usa capital_per_exchange_check per il controllo dei requisiti di capitale
-            capital_check = self.check_capital_requirements(exchange_long, exchange_short, capital_per_exchange_check, is_increment=is_increment)
-            if not capital_check['overall_success']:
+            capital_check = self.check_capital_requirements(exchange_long, exchange_short, capital_per_exchange_check, is_increment=is_increment,
+                                                            balances=(long_balance, short_balance))
+            if not capital_check.overall_success:
                 logger.error(f"Controllo capitale fallito: {capital_check}")
                 return self._handle_balance_failure(capital_check, user_id)
             
@@ -219,8 +416,8 @@ class TradingOpener:
             logger.info(f"Capitale con leva per exchange: {capital_with_leverage} (per calcolo size)")
             
             # Ottieni prezzi SOLANA
-            price_long = exchange_manager.get_solana_price(exchange_long)
-            price_short = exchange_manager.get_solana_price(exchange_short)
+            price_long = self.exchange_manager.get_solana_price(exchange_long)
+            price_short = self.exchange_manager.get_solana_price(exchange_short)
             
             if not price_long or not price_short:
                 logger.error("Errore recupero prezzi SOLANA")
@@ -228,8 +425,8 @@ class TradingOpener:
             
             # Calcola size per entrambi gli exchange usando capitale con leva
             avg_price = (price_long + price_short) / 2
-            size_long = exchange_manager.calculate_solana_size(capital_with_leverage, avg_price)
-            size_short = exchange_manager.calculate_solana_size(capital_with_leverage, avg_price)
+            size_long = self.exchange_manager.calculate_solana_size(capital_with_leverage, avg_price)
+            size_short = self.exchange_manager.calculate_solana_size(capital_with_leverage, avg_price)
             
             if size_long <= 0 or size_short <= 0:
                 logger.error("Size calcolate non valide")
@@ -261,49 +458,48 @@ class TradingOpener:
                 
                 return "success"
             else:
-                return "trading_error"
+                # Motivo di stop registrato durante l'apertura (es. una sola gamba eseguita)
+                return self._local.stop_reason or "trading_error"
             
         except Exception as e:
             logger.error(f"Errore esecuzione strategia: {e}")
             return "error"
     
-    def check_capital_requirements(self, exchange_long: str, exchange_short: str, required_amount: float, is_increment: bool = False) -> Dict:
-        """Controlla capitale totale, distribuzione tra exchange e esegue automaticamente trasferimenti interni"""
-        results = {
-            'long_exchange': {'name': exchange_long, 'success': False, 'balance': 0},
-            'short_exchange': {'name': exchange_short, 'success': False, 'balance': 0},
-            'total_capital': 0,
-            'required_total': required_amount * 2,
-            'overall_success': False,
-            'needs_transfer': False
-        }
+    def check_capital_requirements(self, exchange_long: str, exchange_short: str, required_amount: float, is_increment: bool = False,
+                                   balances: Optional[Tuple[float, float]] = None) -> CapitalCheck:
+        """Controlla capitale totale, distribuzione tra exchange e esegue automaticamente trasferimenti interni
+        
+        Args:
+            balances: Saldi totali (long, short) già letti nello stesso ciclo; se None vengono richiesti agli exchange
+        """
+        results = CapitalCheck(exchange_long=exchange_long, exchange_short=exchange_short, required_total=required_amount * 2)
         
         try:
             # STEP 1: Controllo capitale totale da TUTTI i wallet
             # Usiamo sempre 'total' per sommare tutti i fondi disponibili
-            long_balance = self._get_exchange_balance(exchange_long, balance_type='total')
-            short_balance = self._get_exchange_balance(exchange_short, balance_type='total')
+            if balances is not None:
+                long_balance, short_balance = balances
+            else:
+                long_balance, short_balance = self._fetch_total_balances(exchange_long, exchange_short)
             
-            results['long_exchange'] = {'name': exchange_long, 'balance': long_balance}
-            results['short_exchange'] = {'name': exchange_short, 'balance': short_balance}
-            results['total_capital'] = long_balance + short_balance
+            results.long_balance = long_balance
+            results.short_balance = short_balance
+            results.total_capital = long_balance + short_balance
             
-            logger.info(f"STEP 1 - Capitale totale: {results['total_capital']} USDT (richiesto: {results['required_total']})")
+            logger.info(f"STEP 1 - Capitale totale: {results.total_capital} USDT (richiesto: {results.required_total})")
             logger.info(f"Distribuzione: {exchange_long}={long_balance}, {exchange_short}={short_balance}")
             
             # Verifica se capitale totale è sufficiente
-            if results['total_capital'] < results['required_total']:
-                logger.warning(f"STEP 1 FALLITO - Capitale totale insufficiente: {results['total_capital']} < {results['required_total']}")
-                results['overall_success'] = False
+            if results.total_capital < results.required_total:
+                logger.warning(f"STEP 1 FALLITO - Capitale totale insufficiente: {results.total_capital} < {results.required_total}")
+                results.overall_success = False
                 return results
             
             logger.info("STEP 1 OK - Capitale totale sufficiente")
             
             # STEP 2: Controllo distribuzione tra exchange (con tolleranza 1%)
             target_per_exchange = required_amount
-            tolerance_percent = 1.0  # 1% di tolleranza
-            tolerance_amount = target_per_exchange * (tolerance_percent / 100.0)
-            min_acceptable_per_exchange = target_per_exchange - tolerance_amount
+            min_acceptable_per_exchange = target_per_exchange * self._DISTRIBUTION_TOLERANCE
             
             long_sufficient = long_balance >= min_acceptable_per_exchange
             short_sufficient = short_balance >= min_acceptable_per_exchange
@@ -317,8 +513,8 @@ class TradingOpener:
             if not (long_sufficient and short_sufficient):
                 logger.warning(f"STEP 2 FALLITO - Distribuzione tra exchange insufficiente (anche con tolleranza 1%)")
                 logger.warning(f"Long: {long_balance}/{target_per_exchange} (min: {min_acceptable_per_exchange:.4f}), Short: {short_balance}/{target_per_exchange} (min: {min_acceptable_per_exchange:.4f})")
-                results['overall_success'] = False
-                results['needs_transfer'] = True
+                results.overall_success = False
+                results.needs_transfer = True
                 return results
             
             logger.info("STEP 2 OK - Distribuzione tra exchange sufficiente")
@@ -328,12 +524,12 @@ class TradingOpener:
             
             if internal_transfer_success:
                 logger.info("STEP 3 OK - Wallet interni pronti per il trading")
-                results['overall_success'] = True
-                results['needs_transfer'] = False
+                results.overall_success = True
+                results.needs_transfer = False
             else:
                 logger.warning("STEP 3 FALLITO - Impossibile preparare wallet interni")
-                results['overall_success'] = False
-                results['needs_transfer'] = False
+                results.overall_success = False
+                results.needs_transfer = False
             
             return results
             
@@ -381,7 +577,7 @@ class TradingOpener:
     def _get_bitfinex_wallet_distribution(self) -> Dict:
         """Ottiene la distribuzione dettagliata dei fondi tra i wallet Bitfinex"""
         try:
-            exchange = exchange_manager.exchanges['bitfinex']
+            exchange = self.exchange_manager.exchanges['bitfinex']
             wallets = ['exchange', 'margin', 'funding']
             currencies = ['USTF0', 'USDT', 'UST']
             distribution = {}
@@ -396,7 +592,7 @@ class TradingOpener:
             try:
                 logger.debug("Recupero bilanci Bitfinex usando array info...")
                 balance = exchange.fetch_balance()
-                logger.debug(f"Balance completo: {balance}")
+                logger.debug("Balance completo: %s", balance)
                 
                 # Estrae i balance dall'array 'info' (metodo che funziona)
                 if 'info' in balance and isinstance(balance['info'], list):
@@ -406,12 +602,12 @@ class TradingOpener:
                             entry_currency = balance_entry[1]
                             entry_total = float(balance_entry[4]) if balance_entry[4] else 0
                             
-                            logger.debug(f"Entry: wallet={entry_wallet}, currency={entry_currency}, total={entry_total}")
+                            logger.debug("Entry: wallet=%s, currency=%s, total=%s", entry_wallet, entry_currency, entry_total)
                             
                             # Filtra solo i wallet e valute che ci interessano
                             if entry_wallet in wallets and entry_currency in currencies and entry_total > 0:
                                 distribution[entry_wallet][entry_currency] = entry_total
-                                logger.debug(f"Aggiunto: {entry_wallet}.{entry_currency} = {entry_total}")
+                                logger.debug("Aggiunto: %s.%s = %s", entry_wallet, entry_currency, entry_total)
                 else:
                     logger.warning("Array 'info' non trovato nel balance Bitfinex")
                             
@@ -435,7 +631,7 @@ class TradingOpener:
                 'grand_total': sum(wallet_totals.values())
             }
             
-            logger.debug(f"Distribuzione fondi Bitfinex: {distribution}")
+            logger.debug("Distribuzione fondi Bitfinex: %s", distribution)
             return distribution
             
         except Exception as e:
@@ -481,7 +677,7 @@ class TradingOpener:
                         transfer_plan.append(transfer_step)
                         remaining_amount -= transfer_amount
                         
-                        logger.debug(f"Piano trasferimento: {transfer_amount} {currency} da {wallet} a margin")
+                        logger.debug("Piano trasferimento: %s %s da %s a margin", transfer_amount, currency, wallet)
             
             if remaining_amount > 0:
                 logger.warning(f"Piano trasferimento incompleto: mancano {remaining_amount} USDT")
@@ -535,7 +731,7 @@ class TradingOpener:
             available_for_transfer = total_balance - derivatives_balance
             
             # Applica tolleranza 1% per evitare blocchi per piccole differenze
-            tolerance_threshold = transfer_amount * 0.99  # 99% dell'importo richiesto
+            tolerance_threshold = transfer_amount * self._DISTRIBUTION_TOLERANCE
             
             if available_for_transfer < tolerance_threshold:
                 error_msg = f"Fondi insufficienti per trasferimento (con tolleranza 1%): disponibili {available_for_transfer}, richiesti {transfer_amount}, soglia minima {tolerance_threshold:.2f}"
@@ -619,6 +815,17 @@ class TradingOpener:
     
 
     
+    def _fetch_total_balances(self, exchange_long: str, exchange_short: str) -> Tuple[float, float]:
+        """Legge in parallelo i saldi totali dei due exchange
+        
+        Returns:
+            Tuple[float, float]: Saldi totali (long, short)
+        """
+        fetch = self._in_bot_context(self._get_exchange_balance)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            long_balance, short_balance = executor.map(fetch, (exchange_long, exchange_short))
+        return long_balance, short_balance
+    
     def _get_exchange_balance(self, exchange_name: str, balance_type: str = 'total') -> float:
         """Ottiene saldo disponibile su un exchange
         
@@ -633,12 +840,12 @@ class TradingOpener:
         try:
             if exchange_name.lower() == 'bitmex':
                 # BitMEX non ha wallet separati, quindi total = tradable
-                exchange = exchange_manager.exchanges['bitmex']
+                exchange = self.exchange_manager.exchanges['bitmex']
                 balance = exchange.fetch_balance()
                 return balance.get('USDT', {}).get('total', 0)
             
             elif exchange_name.lower() == 'bitfinex':
-                exchange = exchange_manager.exchanges['bitfinex']
+                exchange = self.exchange_manager.exchanges['bitfinex']
                 
                 if balance_type == 'derivatives':
                     # Solo USTF0 dal wallet margin (derivatives wallet)
@@ -653,18 +860,12 @@ class TradingOpener:
                         
                         # Estrae i balance dall'array 'info' (metodo del balance_checker)
                         if 'info' in balance and isinstance(balance['info'], list):
-                            for balance_entry in balance['info']:
-                                if len(balance_entry) >= 5:
-                                    entry_wallet = balance_entry[0]
-                                    entry_currency = balance_entry[1]
-                                    entry_total = float(balance_entry[4]) if balance_entry[4] else 0
-                                    
-                                    # Cerca USTF0 nel wallet margin
-                                    if entry_wallet == 'margin' and entry_currency == 'USTF0' and entry_total > 0:
-                                        ustf0_balance = entry_total
-                                        break
+                            # Cerca USTF0 nel wallet margin
+                            rows = _bitfinex_available(balance['info'], ('margin',), ('USTF0',))
+                            if rows:
+                                ustf0_balance = rows[0][2]
                         
-                        logger.debug(f"Bitfinex derivatives balance (USTF0): {ustf0_balance}")
+                        logger.debug("Bitfinex derivatives balance (USTF0): %s", ustf0_balance)
                         return ustf0_balance
                     except Exception as e:
                         logger.error(f"Errore recupero saldo derivatives Bitfinex: {e}")
@@ -684,18 +885,12 @@ class TradingOpener:
                         
                         # Se non trova nulla, legge dall'array 'info' (correzione per il bug)
                         if tradable_balance == 0 and 'info' in balance and isinstance(balance['info'], list):
-                            for balance_entry in balance['info']:
-                                if len(balance_entry) >= 5:
-                                    entry_wallet = balance_entry[0]
-                                    entry_currency = balance_entry[1]
-                                    entry_total = float(balance_entry[4]) if balance_entry[4] else 0
-                                    
-                                    # Cerca USDT e UST nel wallet margin
-                                    if entry_wallet == 'margin' and entry_currency in currencies and entry_total > 0:
-                                        tradable_balance += entry_total
-                                        logger.debug(f"Bitfinex tradable balance da info: {entry_currency} = {entry_total}")
+                            # Cerca USDT e UST nel wallet margin
+                            for _, entry_currency, entry_total in _bitfinex_available(balance['info'], ('margin',), currencies):
+                                tradable_balance += entry_total
+                                logger.debug("Bitfinex tradable balance da info: %s = %s", entry_currency, entry_total)
                         
-                        logger.debug(f"Bitfinex tradable balance: {tradable_balance} USDT")
+                        logger.debug("Bitfinex tradable balance: %s USDT", tradable_balance)
                         return tradable_balance
                     except Exception as e:
                         logger.error(f"Errore recupero saldo tradable Bitfinex: {e}")
@@ -707,6 +902,19 @@ class TradingOpener:
                     currencies = ['USTF0', 'USDT', 'UST']
                     total_balance = 0
                     
+                    # Una sola richiesta per tutti i wallet: righe [wallet, valuta, saldo, interessi, disponibile]
+                    try:
+                        wallet_rows = exchange.privatePostAuthRWallets()
+                        for entry_wallet, entry_currency, entry_available in _bitfinex_available(wallet_rows, wallets, currencies):
+                            total_balance += entry_available
+                            logger.debug("Bitfinex %s wallet - %s: %s", entry_wallet, entry_currency, entry_available)
+                        
+                        logger.debug("Bitfinex total balance (tutti i wallet): %s USDT", total_balance)
+                        return total_balance
+                    except Exception as e:
+                        logger.warning(f"Errore recupero wallet Bitfinex, lettura per singolo wallet: {e}")
+                        total_balance = 0
+                    
                     for wallet in wallets:
                         try:
                             balance = exchange.fetch_balance({'type': wallet})
@@ -717,27 +925,21 @@ class TradingOpener:
                                 if currency in balance and balance[currency]['free'] > 0:
                                     amount = balance[currency]['free']
                                     wallet_balance += amount
-                                    logger.debug(f"Bitfinex {wallet} wallet - {currency}: {amount}")
+                                    logger.debug("Bitfinex %s wallet - %s: %s", wallet, currency, amount)
                             
                             # Se non trova nulla, legge dall'array 'info' (correzione per il bug)
                             if wallet_balance == 0 and 'info' in balance and isinstance(balance['info'], list):
-                                for balance_entry in balance['info']:
-                                    if len(balance_entry) >= 5:
-                                        entry_wallet = balance_entry[0]
-                                        entry_currency = balance_entry[1]
-                                        entry_total = float(balance_entry[4]) if balance_entry[4] else 0
-                                        
-                                        # Cerca tutte le valute nel wallet corrente
-                                        if entry_wallet == wallet and entry_currency in currencies and entry_total > 0:
-                                            wallet_balance += entry_total
-                                            logger.debug(f"Bitfinex {wallet} wallet da info - {entry_currency}: {entry_total}")
+                                # Cerca tutte le valute nel wallet corrente
+                                for _, entry_currency, entry_total in _bitfinex_available(balance['info'], (wallet,), currencies):
+                                    wallet_balance += entry_total
+                                    logger.debug("Bitfinex %s wallet da info - %s: %s", wallet, entry_currency, entry_total)
                             
                             total_balance += wallet_balance
                                     
                         except Exception as e:
                             logger.warning(f"Errore recupero saldo {wallet}: {e}")
                     
-                    logger.debug(f"Bitfinex total balance (tutti i wallet): {total_balance} USDT")
+                    logger.debug("Bitfinex total balance (tutti i wallet): %s USDT", total_balance)
                     return total_balance
             
             return 0
@@ -746,14 +948,14 @@ class TradingOpener:
             logger.error(f"Errore recupero saldo {exchange_name} ({balance_type}): {e}")
             return 0
     
-    def _handle_balance_failure(self, capital_check: Dict, user_id: str) -> str:
+    def _handle_balance_failure(self, capital_check: CapitalCheck, user_id: str) -> str:
         """Gestisce i diversi tipi di fallimento del controllo capitale"""
         try:
             # Recupera lo stato attuale del bot
             current_bot = bot_manager.get_user_bot(user_id)
             current_status = current_bot.get('status') if current_bot else None
             
-            if capital_check['total_capital'] < capital_check['required_total']:
+            if capital_check.total_capital < capital_check.required_total:
                 # STEP 1 FALLITO: Capitale totale insufficiente
                 if current_status == BOT_STATUS["TRANSFERING"]:
                     # Se è TRANSFERING, mantieni lo stato (trasferimento potrebbe essere in corso)
@@ -765,7 +967,7 @@ class TradingOpener:
                     bot_manager.update_bot_status(user_id, BOT_STATUS["STOPPED"], "not_enough_capital")
                     return "insufficient_capital"
             
-            elif capital_check['needs_transfer']:
+            elif capital_check.needs_transfer:
                 # STEP 2 FALLITO: Capitale sufficiente ma mal distribuito tra exchange
                 if current_status == BOT_STATUS["TRANSFERING"]:
                     # Se è TRANSFERING, mantieni lo stato (trasferimento potrebbe essere in corso)
@@ -788,36 +990,34 @@ class TradingOpener:
     
     def validate_api_keys(self, api_keys: Dict, exchange_long: str, exchange_short: str) -> bool:
         """Valida che le API keys siano disponibili"""
-        required_keys = [
-            f"{exchange_long}_api_key",
-            f"{exchange_long}_api_secret",
-            f"{exchange_short}_api_key",
-            f"{exchange_short}_api_secret"
-        ]
-        
-        for key in required_keys:
-            if not api_keys.get(key):
-                logger.error(f"API key mancante: {key}")
-                return False
+        required_keys = _required_api_keys(exchange_long, exchange_short)
+        if all(api_keys.get(key) for key in required_keys):
+            return True
         
-        return True
+        missing = next(key for key in required_keys if not api_keys.get(key))
+        logger.error(f"API key mancante: {missing}")
+        return False
     
     def initialize_exchanges(self, api_keys: Dict, exchange_long: str, exchange_short: str) -> bool:
-        """Inizializza connessioni agli exchange"""
+        """Inizializza in parallelo le connessioni agli exchange long e short
+        
+        TLS handshake e load_markets dei due exchange si sovrappongono.
+        """
         try:
-            # Inizializza exchange long
-            success_long = exchange_manager.initialize_exchange(
-                exchange_long,
-                api_keys[f"{exchange_long}_api_key"],
-                api_keys[f"{exchange_long}_api_secret"]
-            )
-            
-            # Inizializza exchange short
-            success_short = exchange_manager.initialize_exchange(
-                exchange_short,
-                api_keys[f"{exchange_short}_api_key"],
-                api_keys[f"{exchange_short}_api_secret"]
-            )
+            # L'ExchangeManager è per-thread: va risolto qui e non nei worker
+            manager = self.exchange_manager
+            
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futures = [
+                    executor.submit(
+                        manager.initialize_exchange,
+                        exchange_name,
+                        api_keys[f"{exchange_name}_api_key"],
+                        api_keys[f"{exchange_name}_api_secret"]
+                    )
+                    for exchange_name in (exchange_long, exchange_short)
+                ]
+                success_long, success_short = (future.result() for future in futures)
             
             return success_long and success_short
             
@@ -855,7 +1055,7 @@ class TradingOpener:
                 logger.info(f"Conversione UST->USTF0 nel margin wallet: {ust_in_margin} UST")
                 
                 # Usa l'API privata per la conversione interna (stesso metodo del test)
-                exchange = exchange_manager.exchanges['bitfinex']
+                exchange = self.exchange_manager.exchanges['bitfinex']
                 
                 params = {
                     "from": "margin",
@@ -900,76 +1100,44 @@ class TradingOpener:
                 if not self._convert_ust_to_ustf0_in_margin():
                     logger.warning("Conversione UST->USTF0 fallita, ma continuo con l'apertura posizioni")
             
-            # Apri posizione LONG
-            order_long = exchange_manager.create_market_order(
-                exchange_long, 'buy', size_long, leverage
-            )
+            # Apri LONG e SHORT in parallelo: nessuna esposizione direzionale tra le due gambe.
+            # L'ExchangeManager è per-thread: va risolto qui e non nei worker
+            manager = self.exchange_manager
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                future_long = executor.submit(self._open_leg, manager, exchange_long, 'buy', size_long, leverage)
+                future_short = executor.submit(self._open_leg, manager, exchange_short, 'sell', size_short, leverage)
+                order_long, order_short = future_long.result(), future_short.result()
             
-            if not order_long:
-                logger.error(f"Errore apertura posizione long su {exchange_long}")
-                # Tentativo con leva adattiva
-                adaptive_success = False
-                step = 0.1
-                max_increase = 0.5
-                attempts = int(max_increase / step)
-                for i in range(1, attempts + 1):
-                    new_lev = round(leverage + i * step, 2)
-                    order_long = exchange_manager.create_market_order(
-                        exchange_long, 'buy', size_long, new_lev
-                    )
-                    if order_long:
-                        adaptive_success = True
-                        leverage_long_used = new_lev
-                        break
-                if not adaptive_success:
-                    return False
+            if not order_long and not order_short:
+                return False
+            
+            if not order_long or not order_short:
+                # Una sola gamba eseguita: chiudila per non restare scoperti e ferma il bot
+                if order_long:
+                    self._rollback_leg(exchange_long, order_long, "long", user_id, bot_id, leverage, bot_config)
                 else:
-                    leverage = leverage  # manteniamo la leva utente per l'altro lato
+                    self._rollback_leg(exchange_short, order_short, "short", user_id, bot_id, leverage, bot_config)
+                self._local.stop_reason = "leverage_insufficient"
+                return False
             
             logger.info(f"Posizione long aperta su {exchange_long}: {order_long}")
-            
-            # Salva posizione LONG nel database
-            self.save_position_to_db(order_long, user_id, bot_id, exchange_long, "long", leverage, bot_config)
-            
-            # Apri posizione SHORT
-            order_short = exchange_manager.create_market_order(
-                exchange_short, 'sell', size_short, leverage
-            )
-            
-            if not order_short:
-                logger.error(f"Errore apertura posizione short su {exchange_short}")
-                # Leva adattiva lato short
-                adaptive_success = False
-                step = 0.1
-                max_increase = 0.5
-                attempts = int(max_increase / step)
-                for i in range(1, attempts + 1):
-                    new_lev = round(leverage + i * step, 2)
-                    order_short = exchange_manager.create_market_order(
-                        exchange_short, 'sell', size_short, new_lev
-                    )
-                    if order_short:
-                        adaptive_success = True
-                        break
-                if not adaptive_success:
-                    # Chiudi long e aggiorna DB e bot status
-                    close_result = exchange_manager.close_position(exchange_long)
-                    close_order = close_result.get('order') if isinstance(close_result, dict) else None
-                    close_price = None
-                    if isinstance(close_order, dict):
-                        close_price = close_order.get('average') or close_order.get('price')
-                    position_manager.update_position_status(
-                        position_id=order_long.get('id'),
-                        status="closed",
-                        close_data={"close_price": float(close_price) if close_price else None, "realized_pnl": None, "close_reason": "hedge_failed"}
-                    )
-                    bot_manager.update_bot_status(user_id, BOT_STATUS["STOPPED"], "leverage_insufficient")
-                    return False
-            
             logger.info(f"Posizione short aperta su {exchange_short}: {order_short}")
             
-            # Salva posizione SHORT nel database
-            self.save_position_to_db(order_short, user_id, bot_id, exchange_short, "short", leverage, bot_config)
+            # Salva le posizioni nel database solo dopo la conferma di entrambe le gambe
+            # e con un unico insert per entrambi i documenti
+            # I due documenti vengono preparati in parallelo: le eventuali letture del
+            # liquidation price dagli exchange si sovrappongono
+            build_doc = self._in_bot_context(self._build_position_doc)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                future_long = executor.submit(build_doc, order_long, user_id, bot_id, exchange_long, "long", leverage, bot_config)
+                future_short = executor.submit(build_doc, order_short, user_id, bot_id, exchange_short, "short", leverage, bot_config)
+                docs = [future_long.result(), future_short.result()]
+            saved = position_manager.save_positions([doc for doc in docs if doc is not None])
+            if saved == len(docs):
+                logger.info(f"✅ Posizioni long/short salvate nel database: "
+                            f"{docs[0]['position_id']}, {docs[1]['position_id']}")
+            else:
+                logger.error(f"❌ Salvate {saved}/{len(docs)} posizioni nel database")
             
             logger.info("✅ Strategia di funding arbitrage attivata con successo!")
             
@@ -979,6 +1147,64 @@ class TradingOpener:
             logger.error(f"Errore creazione nuove posizioni: {e}")
             return False
     
+    def _open_leg(self, manager: ExchangeManager, exchange_name: str, side: str, size: float, leverage: float) -> Optional[Dict]:
+        """
+        Apre una gamba della strategia; se l'ordine fallisce riprova con leva adattiva (+0.1 fino a +0.5)
+        
+        Eseguito in un worker: usa l'ExchangeManager passato dal thread che processa il bot.
+        
+        Args:
+            manager: ExchangeManager del bot
+            exchange_name: Nome dell'exchange
+            side: 'buy' (long) o 'sell' (short)
+            size: Size in SOL
+            leverage: Leva richiesta
+            
+        Returns:
+            dict: Ordine eseguito, None se tutti i tentativi falliscono
+        """
+        order = manager.create_market_order(exchange_name, side, size, leverage)
+        if order:
+            return order
+        
+        logger.error(f"Errore apertura posizione {'long' if side == 'buy' else 'short'} su {exchange_name}")
+        step = 0.1
+        max_increase = 0.5
+        attempts = int(max_increase / step)
+        for i in range(1, attempts + 1):
+            new_lev = round(leverage + i * step, 2)
+            order = manager.create_market_order(exchange_name, side, size, new_lev)
+            if order:
+                return order
+        return None
+    
+    def _rollback_leg(self, exchange_name: str, order: Dict, side: str, user_id: str, bot_id: str,
+                      leverage: float, bot_config: Dict) -> None:
+        """Chiude la gamba aperta quando l'altra è fallita e la registra come chiusa (hedge_failed)
+        
+        La chiusura è un solo ordine reduce-only per la quantità dell'ordine, senza
+        ripiegare sulla chiusura di tutte le posizioni dell'exchange. Se fallisce, la
+        posizione viene salvata aperta nel database (resta visibile a monitor e closer).
+        """
+        close_result = self.exchange_manager.close_position(exchange_name, self._filled_leg(order, side), strict=True)
+        
+        self.save_position_to_db(order, user_id, bot_id, exchange_name, side, leverage, bot_config)
+        if not close_result.get("success"):
+            logger.error(f"🚨 Rollback gamba {side} su {exchange_name} fallito, posizione {order.get('id')} "
+                         f"lasciata aperta: chiusura manuale necessaria ({close_result.get('error')})")
+            return
+        
+        close_order = close_result.get('order')
+        close_price = None
+        if isinstance(close_order, dict):
+            close_price = close_order.get('average') or close_order.get('price')
+        
+        position_manager.update_position_status(
+            position_id=order.get('id'),
+            status="closed",
+            close_data={"close_price": float(close_price) if close_price else None, "realized_pnl": None, "close_reason": "hedge_failed"}
+        )
+    
     def increment_existing_positions(self, exchange_long: str, exchange_short: str, 
                                    size_long: float, size_short: float, leverage: float, 
                                    user_id: str, bot_id: str, bot_config: Dict) -> bool:
@@ -1014,24 +1240,26 @@ class TradingOpener:
                 logger.error(f"❌ Posizioni mancanti per incremento: {long_key} o {short_key}")
                 return False
             
-            # Apri posizioni incrementali
-            order_long = exchange_manager.create_market_order(
-                exchange_long, 'buy', size_long, leverage
-            )
+            # Apri posizioni incrementali in parallelo
+            manager = self.exchange_manager
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                future_long = executor.submit(manager.create_market_order, exchange_long, 'buy', size_long, leverage)
+                future_short = executor.submit(manager.create_market_order, exchange_short, 'sell', size_short, leverage)
+                order_long, order_short = future_long.result(), future_short.result()
             
             if not order_long:
                 logger.error(f"❌ Errore apertura incremento long su {exchange_long}")
+                if order_short:
+                    # Prova a chiudere posizione short incrementale
+                    logger.info("Tentativo chiusura incremento short...")
+                    self._rollback_increment(manager, exchange_short, order_short, "short")
                 return False
             
-            order_short = exchange_manager.create_market_order(
-                exchange_short, 'sell', size_short, leverage
-            )
-            
             if not order_short:
                 logger.error(f"❌ Errore apertura incremento short su {exchange_short}")
                 # Prova a chiudere posizione long incrementale
                 logger.info("Tentativo chiusura incremento long...")
-                exchange_manager.close_position(exchange_long)
+                self._rollback_increment(manager, exchange_long, order_long, "long")
                 return False
             
             logger.info(f"✅ Incrementi aperti - Long: {order_long['amount']}, Short: {order_short['amount']}")
@@ -1056,6 +1284,18 @@ class TradingOpener:
             logger.error(f"❌ Errore incremento posizioni esistenti: {e}")
             return False
     
+    def _rollback_increment(self, manager: ExchangeManager, exchange_name: str, order: Dict, side: str) -> None:
+        """Annulla il solo incremento eseguito con un ordine reduce-only (senza chiudere la posizione esistente)"""
+        close_result = manager.close_position(exchange_name, self._filled_leg(order, side), strict=True)
+        if not close_result.get("success"):
+            logger.error(f"🚨 Annullamento incremento {side} su {exchange_name} fallito: "
+                         f"chiusura manuale necessaria ({close_result.get('error')})")
+    
+    @staticmethod
+    def _filled_leg(order: Dict, side: str) -> Dict:
+        """Posizione da chiudere con un ordine reduce-only pari alla sola quantità eseguita dall'ordine"""
+        return {"symbol": order.get('symbol'), "side": side, "size": order.get('amount')}
+    
     def update_position_with_increment(self, existing_position: Dict, new_order: Dict, bot_config: Dict) -> bool:
         """Aggiorna una posizione esistente con i dati dell'incremento"""
         try:
@@ -1114,22 +1354,40 @@ class TradingOpener:
     def save_position_to_db(self, order: Dict, user_id: str, bot_id: str, exchange_name: str, 
                            side: str, leverage: float, bot_config: Dict) -> bool:
         """Salva posizione nel database dopo apertura ordine"""
+        position_data = self._build_position_doc(order, user_id, bot_id, exchange_name,
+                                                 side, leverage, bot_config)
+        if position_data is None:
+            return False
+
+        success = position_manager.save_position(position_data)
+        if success:
+            logger.info(f"✅ Posizione {side} salvata nel database: {position_data['position_id']}")
+        else:
+            logger.error(f"❌ Errore salvataggio posizione {side} nel database")
+
+        return success
+
+    def _build_position_doc(self, order: Dict, user_id: str, bot_id: str, exchange_name: str,
+                            side: str, leverage: float, bot_config: Dict) -> Optional[Dict]:
+        """Costruisce il documento posizione da salvare dopo apertura ordine"""
         try:
-            from datetime import datetime
+            # Valori numerici dell'ordine, convertiti una sola volta
+            entry_price = float(order.get('average') or order.get('price') or 0)
+            size = float(order.get('amount') or 0)
             
             # Estrai liquidation price dall'ordine se disponibile
-            liquidation_price = None
-            if isinstance(order.get('info'), dict):
+            liquidation_price = order.get('liquidationPrice')
+            info = order.get('info')
+            if not liquidation_price and isinstance(info, dict):
                 # Prova diversi campi per liquidation price
-                liquidation_price = (order['info'].get('liquidationPrice') or 
-                                   order['info'].get('liqPrice') or 
-                                   order.get('liquidationPrice'))
+                liquidation_price = next((info[field] for field in _ORDER_LIQ_PRICE_FIELDS if info.get(field)), None)
             
             # Se non disponibile dall'ordine, prova a recuperarlo dalla posizione
             if not liquidation_price:
                 liquidation_price = self.fetch_liquidation_price(
                     exchange_name, order.get('symbol'), side
                 )
+            liquidation_price = float(liquidation_price) if liquidation_price else None
 
             # Calcola safety_value e rebalance_value se liquidation_price è disponibile
             safety_value = None
@@ -1141,9 +1399,6 @@ class TradingOpener:
                     safety_threshold = bot_config.get('safety_threshold')
                     rebalance_threshold = bot_config.get('rebalance_threshold')
                     
-                    # Estrai entry_price dall'ordine
-                    entry_price = float(order.get('average') or order.get('price', 0))
-                    
                     if safety_threshold and entry_price > 0:
                         safety_value = self.calculate_threshold_value(liquidation_price, safety_threshold, side, entry_price)
                     
@@ -1162,30 +1417,24 @@ class TradingOpener:
                 "exchange": exchange_name,
                 "symbol": order.get('symbol', ''),
                 "side": side,
-                "size": float(order.get('amount', 0)),
-                "entry_price": float(order.get('average') or order.get('price', 0)),
+                "size": size,
+                "entry_price": entry_price,
                 "leverage": float(leverage),
-                "liquidation_price": float(liquidation_price) if liquidation_price else None,
-                "safety_value": float(safety_value) if safety_value else None,
-                "rebalance_value": float(rebalance_value) if rebalance_value else None,
-                "opened_at": datetime.utcnow(),
+                "liquidation_price": liquidation_price,
+                "safety_value": round(safety_value, 6) if safety_value else None,
+                "rebalance_value": round(rebalance_value, 6) if rebalance_value else None,
+                "opened_at": datetime.now(timezone.utc),
                 "closed_at": None,
                 "close_price": None,
                 "realized_pnl": None,
                 "status": "open"
             }
             
-            success = position_manager.save_position(position_data)
-            if success:
-                logger.info(f"✅ Posizione {side} salvata nel database: {position_data['position_id']}")
-            else:
-                logger.error(f"❌ Errore salvataggio posizione {side} nel database")
-            
-            return success
+            return position_data
             
         except Exception as e:
-            logger.error(f"Errore salvataggio posizione {side}: {e}")
-            return False
+            logger.error(f"Errore preparazione posizione {side}: {e}")
+            return None
     
     def fetch_liquidation_price(self, exchange_name: str, symbol: str, side: str) -> float:
         """Recupera liquidation price dalle API dell'exchange
@@ -1198,39 +1447,14 @@ class TradingOpener:
         Returns:
             float: Liquidation price o None se non disponibile
         
-        Note: Funzione duplicata da threshold_monitoring.py per indipendenza del modulo
+        La lettura è condivisa con threshold_monitoring.py (ExchangeManager.get_liquidation_price).
         """
         try:
             # Verifica che l'exchange sia inizializzato
-            if exchange_name not in exchange_manager.exchanges:
+            if exchange_name not in self.exchange_manager.exchanges:
                 return None
             
-            # Per BitMEX usa logica specifica con fetch_positions()
-            if exchange_name.lower() == 'bitmex':
-                exchange = exchange_manager.exchanges[exchange_name]
-                positions = exchange.fetch_positions()
-                for pos in positions:
-                    # BitMEX usa 'contracts' invece di 'size'
-                    contracts = pos.get('contracts', 0)
-                    size = pos.get('size', 0)
-                    
-                    if (pos.get('symbol') == symbol and 
-                        (contracts != 0 or size != 0) and
-                        pos.get('side', '').lower() == side.lower()):
-                        
-                        liquidation_price = pos.get('liquidationPrice')
-                        if liquidation_price:
-                            logger.info(f"Liquidation price recuperato da {exchange_name}: {liquidation_price}")
-                            return float(liquidation_price)
-            else:
-                # Altri exchange: usa exchange_manager.get_position() (metodo testato)
-                position = exchange_manager.get_position(exchange_name)
-                if position and position.get('liquidationPrice'):
-                    liquidation_price = float(position['liquidationPrice'])
-                    logger.info(f"Liquidation price recuperato da {exchange_name}: {liquidation_price}")
-                    return liquidation_price
-            
-            return None
+            return self.exchange_manager.get_liquidation_price(exchange_name, symbol, side)
             
         except Exception as e:
             logger.error(f"Errore recupero liquidation price da {exchange_name}: {e}")
@@ -1251,19 +1475,21 @@ class TradingOpener:
         Note: Nuova logica basata sulla differenza tra entry_price e liquidation_price
         """
         try:
+            is_long = side.lower() == "long"
+            
             # Se entry_price non è fornito, usa la vecchia logica per retrocompatibilità
             if entry_price is None or entry_price <= 0:
                 logger.warning("Entry price non disponibile, uso vecchia logica di calcolo")
                 threshold_amount = liquidation_price * (threshold_percent / 100.0)
-                if side.lower() == "long":
+                if is_long:
                     threshold_value = liquidation_price + threshold_amount
                 else:  # short
                     threshold_value = liquidation_price - threshold_amount
-                return round(threshold_value, 6)
+                return threshold_value
             
             # Nuova logica: calcola la differenza tra entry_price e liquidation_price
             # e applica la percentuale a questa differenza
-            if side.lower() == "long":
+            if is_long:
                 # Per LONG: entry_price > liquidation_price
                 price_difference = entry_price - liquidation_price
                 threshold_amount = price_difference * (threshold_percent / 100.0)
@@ -1274,8 +1500,10 @@ class TradingOpener:
                 threshold_amount = price_difference * (threshold_percent / 100.0)
                 threshold_value = liquidation_price - threshold_amount
             
-            logger.info(f"Calcolo threshold {side}: entry={entry_price}, liq={liquidation_price}, diff={price_difference:.4f}, threshold={threshold_value:.4f}")
-            return round(threshold_value, 6)  # Arrotonda a 6 decimali
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Calcolo threshold %s: entry=%s, liq=%s, diff=%.4f, threshold=%.4f",
+                            side, entry_price, liquidation_price, price_difference, threshold_value)
+            return threshold_value  # Arrotondato a 6 decimali solo nel documento salvato
             
         except Exception as e:
             logger.error(f"Errore calcolo threshold value: {e}")
@@ -1284,7 +1512,7 @@ class TradingOpener:
     def check_bitmex_balance(self, required_amount: float) -> Dict:
         """Controlla saldo USDT su BitMEX"""
         try:
-            balance = exchange_manager.get_balance('bitmex')
+            balance = self.exchange_manager.get_balance('bitmex')
             usdt_balance = balance.get('USDT', {}).get('free', 0)
             
             success = usdt_balance >= required_amount
@@ -1309,11 +1537,11 @@ class TradingOpener:
         try:
             logger.info(f"Trasferimento interno Bitfinex: {amount} USDT da {from_wallet} a {to_wallet}")
             
-            actual_currency = "USTF0" if from_wallet == "margin" else "UST"
-            actual_currency_to = "USTF0" if to_wallet == "margin" else "UST"
+            actual_currency = _BFX_WALLET_CURRENCY.get(from_wallet, "UST")
+            actual_currency_to = _BFX_WALLET_CURRENCY.get(to_wallet, "UST")
             
             # Usa l'exchange manager esistente
-            exchange = exchange_manager.exchanges['bitfinex']
+            exchange = self.exchange_manager.exchanges['bitfinex']
             
             params = {
                 "from": from_wallet,
@@ -1326,8 +1554,9 @@ class TradingOpener:
                 params["currency_to"] = actual_currency_to
                 logger.info(f"Conversione da {actual_currency} a {actual_currency_to}")
             
-            if hasattr(exchange, 'privatePostAuthWTransfer'):
-                result = exchange.privatePostAuthWTransfer(params)
+            transfer = getattr(exchange, 'privatePostAuthWTransfer', None)
+            if transfer is not None:
+                result = transfer(params)
                 
                 if result and isinstance(result, list) and len(result) > 0:
                     status = result[6] if len(result) > 6 else "UNKNOWN"
@@ -197,8 +197,8 @@ class PositionCloser:
                     "error": f"Errore connessione a {exchange_name}: {str(conn_error)}"
                 }
             
-            # Usa il metodo esistente di exchange_manager
-            result = exchange_manager.close_position(exchange_name)
+            # Chiusura guidata dalla posizione del database (ricerca sull'exchange solo come ripiego)
+            result = exchange_manager.close_position(exchange_name, position)
             
             # Gestisci i diversi tipi di risultato
             if isinstance(result, dict):
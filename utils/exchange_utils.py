@@ -3,16 +3,25 @@ Utility per gestione exchange e problemi comuni
 """
 import time
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
+# Ultimo nonce Bitfinex emesso (millisecondi) e lock per l'incremento atomico:
+# condiviso da CCXT e dalle chiamate REST dirette, che usano le stesse API keys
+_last_nonce = 0
+_nonce_lock = threading.Lock()
+
 class ExchangeUtils:
     """Utility per problemi comuni degli exchange"""
     
     @staticmethod
     def get_bitfinex_nonce():
-        """Genera nonce per Bitfinex (timestamp in millisecondi)"""
-        return int(time.time() * 1000)
+        """Genera nonce per Bitfinex (timestamp in millisecondi, strettamente crescente tra thread)"""
+        global _last_nonce
+        with _nonce_lock:
+            _last_nonce = max(_last_nonce + 1, int(time.time() * 1000))
+            return _last_nonce
     
     @staticmethod
     def wait_for_nonce_reset(seconds: int = 5):